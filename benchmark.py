@@ -0,0 +1,262 @@
+from xml.etree import ElementTree
+from PyPDF2 import PdfFileWriter
+import io
+import os
+import sys
+import copy
+import time
+import argparse
+import tracemalloc
+import extract
+import folio
+
+
+################################################################################
+# Synthetic characters
+################################################################################
+
+
+def numbered_children(element):
+    return [child for child in element if child.tag.startswith("id-")]
+
+
+def renumber(element):
+    for i, child in enumerate(numbered_children(element)):
+        child.tag = "id-{0:05d}".format(i + 1)
+
+
+def grow_list(list_element, count):
+    # Repeats the existing entries of a FantasyGrounds list until it holds
+    # count of them, renaming the copies so each one is distinct.
+    originals = numbered_children(list_element)
+    if not originals:
+        return
+    for i in range(len(originals), count):
+        item = copy.deepcopy(originals[i % len(originals)])
+        name = item.find("name")
+        if name is not None and name.text:
+            name.text = "{0} {1}".format(name.text, i // len(originals) + 1)
+        list_element.append(item)
+    renumber(list_element)
+
+
+def grow_spells(spellset, count):
+    # Spreads count spells over levels 0-9 of the first spell set, adding
+    # any level the character does not have yet.
+    first_set = spellset.find("id-00001")
+    levels = first_set.find("levels")
+    originals = []
+    for level in levels:
+        spells = level.find("spells")
+        if spells is not None:
+            originals.extend(numbered_children(spells))
+            for spell in numbered_children(spells):
+                spells.remove(spell)
+    if not originals:
+        return
+
+    for number in range(10):
+        if levels.find("level{0}".format(number)) is None:
+            level = ElementTree.SubElement(levels, "level{0}".format(number))
+            ElementTree.SubElement(level, "level", type="number").text = str(number)
+            ElementTree.SubElement(level, "spells")
+    for i in range(count):
+        spell = copy.deepcopy(originals[i % len(originals)])
+        name = spell.find("name")
+        if name is not None and name.text and i >= len(originals):
+            name.text = "{0} {1}".format(name.text, i // len(originals) + 1)
+        levels.find("level{0}".format(i % 10)).find("spells").append(spell)
+    for level in levels:
+        renumber(level.find("spells"))
+
+
+def scale_character(source, destination, inventory=500, spells=200, feats=100):
+    tree = ElementTree.parse(source)
+    character = tree.getroot().find("character")
+    for tag, count in (("inventorylist", inventory), ("featlist", feats)):
+        list_element = character.find(tag)
+        if list_element is not None:
+            grow_list(list_element, count)
+    spellset = character.find("spellset")
+    if spellset is not None:
+        grow_spells(spellset, spells)
+    tree.write(destination, encoding="utf-8", xml_declaration=True)
+    return destination
+
+
+################################################################################
+# Stages
+################################################################################
+
+
+# Wraps folio.overlay_page so the time spent merging (or stamping) template
+# pages can be told apart from the time spent drawing the overlay.
+class MergeTimer:
+    def __init__(self):
+        self.elapsed = 0.0
+        self.overlay_page = folio.overlay_page
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.overlay_page(*args, **kwargs)
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+    def __enter__(self):
+        folio.overlay_page = self
+        return self
+
+    def __exit__(self, *exc_info):
+        folio.overlay_page = self.overlay_page
+
+
+def run_stages(filename, template, stamp):
+    timings = {}
+
+    start = time.perf_counter()
+    root = ElementTree.parse(filename).getroot()
+    timings["parse"] = time.perf_counter() - start
+
+    character_element = root.find("character")
+    for tag, (key, extractor) in extract.SECTION_EXTRACTORS.items():
+        if character_element.find(tag) is None:
+            continue
+        start = time.perf_counter()
+        extractor(character_element)
+        timings["extract_" + key] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    character = extract.load_character(filename)
+    timings["load_character"] = time.perf_counter() - start
+
+    if template is None:
+        return timings
+
+    # time a full render rather than one served from the page cache
+    folio.PAGE_CACHE.clear()
+    existing_pdf = folio.load_template(template).copy()
+    with MergeTimer() as merge:
+        start = time.perf_counter()
+        pages = folio.folio_pages(character, existing_pdf, stamp)
+        elapsed = time.perf_counter() - start
+    timings["draw"] = elapsed - merge.elapsed
+    timings["stamp" if stamp else "merge"] = merge.elapsed
+
+    start = time.perf_counter()
+    output = PdfFileWriter()
+    for page in pages:
+        output.addPage(page)
+    output.write(io.BytesIO())
+    timings["write"] = time.perf_counter() - start
+    return timings
+
+
+def measure_peaks(filename, template, stamp):
+    # A separate pass, since tracing allocations slows every stage down.
+    peaks = {}
+    tracemalloc.start()
+    try:
+        for stage in ("parse", "load_character", "render"):
+            tracemalloc.reset_peak()
+            if stage == "parse":
+                ElementTree.parse(filename)
+            elif stage == "load_character":
+                character = extract.load_character(filename)
+            elif template is not None:
+                folio.PAGE_CACHE.clear()
+                existing_pdf = folio.load_template(template).copy()
+                output = PdfFileWriter()
+                for page in folio.folio_pages(character, existing_pdf, stamp):
+                    output.addPage(page)
+                output.write(io.BytesIO())
+            else:
+                continue
+            peaks[stage] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def benchmark(filename, repeat, template, stamp):
+    samples = {}
+    run_stages(filename, template, stamp)  # warm the template cache
+    for _ in range(repeat):
+        for stage, elapsed in run_stages(filename, template, stamp).items():
+            samples.setdefault(stage, []).append(elapsed)
+    return samples, measure_peaks(filename, template, stamp)
+
+
+def report(filename, samples, peaks, out=sys.stdout):
+    out.write("{0}\n".format(filename))
+    out.write("  {0:<28}{1:>10}{2:>10}\n".format("stage", "p50 ms", "p95 ms"))
+    for stage, values in samples.items():
+        out.write(
+            "  {0:<28}{1:>10.2f}{2:>10.2f}\n".format(
+                stage, percentile(values, 0.5) * 1000, percentile(values, 0.95) * 1000
+            )
+        )
+    for stage, peak in peaks.items():
+        out.write("  peak memory {0:<16}{1:>10.1f} KiB\n".format(stage, peak / 1024))
+
+
+################################################################################
+# Command line
+################################################################################
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time each stage of reading a character and drawing its folio."
+    )
+    parser.add_argument("inputs", nargs="*", help="character XML files")
+    parser.add_argument("-n", "--repeat", type=int, default=20)
+    parser.add_argument("-t", "--template", default=extract.FOLIO_TEMPLATE)
+    parser.add_argument("--stamp", action="store_true")
+    parser.add_argument(
+        "--scale",
+        metavar="DIR",
+        help="also benchmark each input scaled up to a stress-sized character",
+    )
+    parser.add_argument("--inventory", type=int, default=500)
+    parser.add_argument("--spells", type=int, default=200)
+    parser.add_argument("--feats", type=int, default=100)
+    args = parser.parse_args(argv)
+
+    inputs = args.inputs or sorted(
+        name for name in os.listdir(".") if name.endswith(".xml")
+    )
+    template = args.template
+    if not os.path.exists(template):
+        print("{0} not found, skipping the PDF stages".format(template))
+        template = None
+
+    if args.scale:
+        os.makedirs(args.scale, exist_ok=True)
+        for filename in list(inputs):
+            base = os.path.splitext(os.path.basename(filename))[0]
+            destination = os.path.join(args.scale, base + "_large.xml")
+            scale_character(
+                filename, destination, args.inventory, args.spells, args.feats
+            )
+            inputs.append(destination)
+
+    failed = 0
+    for filename in inputs:
+        try:
+            samples, peaks = benchmark(filename, args.repeat, template, args.stamp)
+        except Exception as e:
+            print("{0}\n  FAIL {1}: {2}".format(filename, type(e).__name__, e))
+            failed += 1
+            continue
+        report(filename, samples, peaks)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,27 @@
-from xml.dom.minidom import parse
-import xml.dom.minidom
-from PyPDF2 import PdfFileWriter, PdfFileReader
+import xml.parsers.expat
+from xml.etree import ElementTree
 import io
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
+import csv
+import weakref
+import threading
+import contextlib
+import functools
+import collections
+import json
+import hashlib
+import os
+import sys
+import glob
+import time
+import argparse
+import concurrent.futures
+import dataclasses
+from dataclasses import dataclass
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 ABILITY_NAMES = [
@@ -40,27 +58,40 @@ AC_SOURCES = [
 ################################################################################
 
 
+def child_elements(element):
+    return list(element)
+
+
+def tag_of(element):
+    return element.tag
+
+
+# Each searched element's children grouped by tag, built the first time the
+# element is searched so every later lookup is a dictionary access.
+CHILD_INDEXES = weakref.WeakKeyDictionary()
+
+
+def child_index(element):
+    index = CHILD_INDEXES.get(element)
+    if index is None:
+        index = {}
+        for child in child_elements(element):
+            index.setdefault(tag_of(child), []).append(child)
+        CHILD_INDEXES[element] = index
+    return index
+
+
 def find_first_child_named(element, name):
-    for c in element.childNodes:
-        if isinstance(c, xml.dom.minidom.Element) and c.nodeName == name:
-            return c
-    return None
+    children = child_index(element).get(name)
+    return children[0] if children else None
 
 
 def find_children_named(element, name):
-    return [
-        c
-        for c in element.childNodes
-        if isinstance(c, xml.dom.minidom.Element) and c.nodeName == name
-    ]
+    return child_index(element).get(name, [])
 
 
 def extract_text(element):
-    return (
-        element.firstChild.wholeText
-        if isinstance(element, xml.dom.minidom.Element)
-        else None
-    )
+    return element.text if element is not None else None
 
 
 def extract_formatted_text(element):
@@ -72,7 +103,7 @@ def extract_nested_names(element):
         x
         for x in [
             extract_text(find_first_child_named(possibly_named_element, "name"))
-            for possibly_named_element in element.childNodes
+            for possibly_named_element in child_elements(element)
         ]
         if x
     ]
@@ -83,6 +114,115 @@ def first_sentence(text):
     return text if period_index == -1 else text[0 : period_index + 1]
 
 
+################################################################################
+# Tracing
+################################################################################
+
+# The Trace that spans and counters are recorded in, or None when tracing is
+# off. Every instrumented spot checks this first, so that is all tracing costs
+# when it is off. Set by enable_tracing.
+TRACE = None
+TRACE_VARIABLE = "FOLIO_TRACE"
+
+
+class Trace:
+    # Spans as Chrome trace events ("X" events, in microseconds) plus named
+    # counters, for chrome://tracing or Perfetto and for a summary table.
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events = []
+        self.counters = collections.Counter()
+        self.threads = {}
+
+    # thread names a lane of its own in the trace, instead of the thread the
+    # span was recorded on.
+    def add(self, name, category, start, end, thread=None):
+        if thread is not None:
+            thread = self.threads.setdefault(thread, len(self.threads) + 1)
+        self.events.append(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (start - self.origin) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": os.getpid(),
+                "tid": threading.get_ident() if thread is None else thread,
+            }
+        )
+
+    @contextlib.contextmanager
+    def span(self, name, category):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, time.perf_counter())
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def write(self, path):
+        end = (time.perf_counter() - self.origin) * 1e6
+        threads = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": {"name": name},
+            }
+            for name, tid in self.threads.items()
+        ]
+        counters = [
+            {
+                "name": name,
+                "ph": "C",
+                "ts": end,
+                "pid": os.getpid(),
+                "args": {"value": value},
+            }
+            for name, value in sorted(self.counters.items())
+        ]
+        with open(path, "w") as trace_file:
+            json.dump(
+                {
+                    "traceEvents": threads + self.events + counters,
+                    "displayTimeUnit": "ms",
+                },
+                trace_file,
+            )
+
+    def report(self, out=sys.stderr):
+        spans = {}
+        for event in self.events:
+            spans.setdefault(event["name"], []).append(event["dur"] / 1000)
+        out.write(
+            "{0:<32}{1:>8}{2:>12}{3:>10}{4:>10}\n".format(
+                "span", "calls", "total ms", "mean ms", "max ms"
+            )
+        )
+        for name, durations in sorted(spans.items(), key=lambda s: -sum(s[1])):
+            out.write(
+                "{0:<32}{1:>8}{2:>12.2f}{3:>10.2f}{4:>10.2f}\n".format(
+                    name,
+                    len(durations),
+                    sum(durations),
+                    sum(durations) / len(durations),
+                    max(durations),
+                )
+            )
+        for name, value in sorted(self.counters.items()):
+            out.write("{0:<32}{1:>8}\n".format(name, value))
+
+
+def enable_tracing():
+    global TRACE
+    if TRACE is None:
+        TRACE = Trace()
+    return TRACE
+
+
 ################################################################################
 # Extraction functions
 ################################################################################
@@ -102,11 +242,7 @@ def extract_level(character):
 
 def extract_classes(character):
     classes = []
-    for class_element in [
-        el
-        for el in find_first_child_named(character, "classes").childNodes
-        if isinstance(el, xml.dom.minidom.Element)
-    ]:
+    for class_element in child_elements(find_first_child_named(character, "classes")):
         classes.append(
             {
                 "name": extract_text(find_first_child_named(class_element, "name")),
@@ -144,7 +280,7 @@ def extract_abilities(character):
     abilities = {}
     abilities_element = find_first_child_named(character, "abilities")
     for ability_name in ABILITY_NAMES:
-        ability_element = abilities_element.getElementsByTagName(ability_name)[0]
+        ability_element = find_first_child_named(abilities_element, ability_name)
         abilities[ability_name] = (
             extract_text(find_first_child_named(ability_element, "score")),
             extract_text(find_first_child_named(ability_element, "bonus")),
@@ -158,10 +294,12 @@ def extract_languages(character):
 
 def extract_proficiencies(character):
     proficiencies = []
-    for proficiency in character.getElementsByTagName("proficiencylist")[
-        0
-    ].getElementsByTagName("name"):
-        proficiencies.append(extract_text(proficiency))
+    for proficiency in child_elements(
+        find_first_child_named(character, "proficiencylist")
+    ):
+        name = find_first_child_named(proficiency, "name")
+        if name is not None:
+            proficiencies.append(extract_text(name))
     return proficiencies
 
 
@@ -170,12 +308,10 @@ def extract_saves(character):
     save_elements = find_first_child_named(character, "saves")
     for save_name in SAVE_NAMES:
         save_data = {}
-        for data_element in [
-            el
-            for el in find_first_child_named(save_elements, save_name).childNodes
-            if isinstance(el, xml.dom.minidom.Element)
-        ]:
-            save_data[data_element.tagName] = extract_text(data_element)
+        for data_element in child_elements(
+            find_first_child_named(save_elements, save_name)
+        ):
+            save_data[tag_of(data_element)] = extract_text(data_element)
         saves[save_name] = save_data
     return saves
 
@@ -196,7 +332,7 @@ def extract_hp(character):
     hp = {}
     hp_element = find_first_child_named(character, "hp")
     for hp_name in HP_TYPES:
-        hp[hp_name] = hp_element.getElementsByTagName(hp_name)[0].firstChild.wholeText
+        hp[hp_name] = extract_text(find_first_child_named(hp_element, hp_name))
     return hp
 
 
@@ -212,10 +348,8 @@ def extract_speed(character):
     speed = {}
     speed_element = find_first_child_named(character, "speed")
 
-    for data_element in [
-        el for el in speed_element.childNodes if isinstance(el, xml.dom.minidom.Element)
-    ]:
-        speed[data_element.tagName] = extract_text(data_element)
+    for data_element in child_elements(speed_element):
+        speed[tag_of(data_element)] = extract_text(data_element)
     return speed
 
 
@@ -244,37 +378,23 @@ def extract_attack_bonuses(character):
     bonuses = {}
     bonuses["base"] = extract_text(find_first_child_named(ab_element, "base"))
     for bonus_element in [
-        el
-        for el in ab_element.childNodes
-        if isinstance(el, xml.dom.minidom.Element) and el.tagName != "base"
+        el for el in child_elements(ab_element) if tag_of(el) != "base"
     ]:
         bonus_data = {}
-        for data_element in [
-            el
-            for el in bonus_element.childNodes
-            if isinstance(el, xml.dom.minidom.Element)
-        ]:
-            bonus_data[data_element.tagName] = extract_text(data_element)
-        bonuses[bonus_element.tagName] = bonus_data
+        for data_element in child_elements(bonus_element):
+            bonus_data[tag_of(data_element)] = extract_text(data_element)
+        bonuses[tag_of(bonus_element)] = bonus_data
     return bonuses
 
 
 def extract_defenses(character):
     defense_element = find_first_child_named(character, "defenses")
     defenses = {}
-    for defense_element in [
-        el
-        for el in defense_element.childNodes
-        if isinstance(el, xml.dom.minidom.Element)
-    ]:
+    for defense_element in child_elements(defense_element):
         defense_data = {}
-        for data_element in [
-            el
-            for el in defense_element.childNodes
-            if isinstance(el, xml.dom.minidom.Element)
-        ]:
-            defense_data[data_element.tagName] = extract_text(data_element)
-        defenses[defense_element.tagName] = defense_data
+        for data_element in child_elements(defense_element):
+            defense_data[tag_of(data_element)] = extract_text(data_element)
+        defenses[tag_of(defense_element)] = defense_data
     return defenses
 
 
@@ -282,22 +402,14 @@ def extract_encumbrance(character):
     encumbrance = {}
     encumbrance_element = find_first_child_named(character, "encumbrance")
 
-    for data_element in [
-        el
-        for el in encumbrance_element.childNodes
-        if isinstance(el, xml.dom.minidom.Element)
-    ]:
-        encumbrance[data_element.tagName] = extract_text(data_element)
+    for data_element in child_elements(encumbrance_element):
+        encumbrance[tag_of(data_element)] = extract_text(data_element)
     return encumbrance
 
 
 def extract_feats(character):
     feats = []
-    for feat_element in [
-        el
-        for el in find_first_child_named(character, "featlist").childNodes
-        if isinstance(el, xml.dom.minidom.Element)
-    ]:
+    for feat_element in child_elements(find_first_child_named(character, "featlist")):
         feats.append(
             {
                 "name": extract_text(find_first_child_named(feat_element, "name")),
@@ -311,11 +423,7 @@ def extract_feats(character):
 
 def extract_traits(character):
     traits = []
-    for trait_element in [
-        el
-        for el in find_first_child_named(character, "traitlist").childNodes
-        if isinstance(el, xml.dom.minidom.Element)
-    ]:
+    for trait_element in child_elements(find_first_child_named(character, "traitlist")):
         traits.append(
             {
                 "name": extract_text(find_first_child_named(trait_element, "name")),
@@ -331,11 +439,7 @@ def extract_traits(character):
 
 def extract_skills(character):
     skills = {}
-    for skill_element in [
-        el
-        for el in find_first_child_named(character, "skilllist").childNodes
-        if isinstance(el, xml.dom.minidom.Element)
-    ]:
+    for skill_element in child_elements(find_first_child_named(character, "skilllist")):
         base_skill_name = extract_text(find_first_child_named(skill_element, "label"))
         sub_skill_name = extract_text(find_first_child_named(skill_element, "sublabel"))
 
@@ -361,11 +465,9 @@ def extract_skills(character):
 
 def extract_inventory(character):
     inventory = []
-    for skill_element in [
-        el
-        for el in find_first_child_named(character, "inventorylist").childNodes
-        if isinstance(el, xml.dom.minidom.Element)
-    ]:
+    for skill_element in child_elements(
+        find_first_child_named(character, "inventorylist")
+    ):
         inventory.append(
             {
                 "name": extract_text(find_first_child_named(skill_element, "name")),
@@ -383,11 +485,9 @@ def extract_inventory(character):
 
 def extract_weapons(character):
     weapons = []
-    for weapon_element in [
-        el
-        for el in find_first_child_named(character, "weaponlist").childNodes
-        if isinstance(el, xml.dom.minidom.Element)
-    ]:
+    for weapon_element in child_elements(
+        find_first_child_named(character, "weaponlist")
+    ):
         weapon = {}
         weapon["name"] = extract_text(find_first_child_named(weapon_element, "name"))
         weapon["attacks"] = extract_text(
@@ -410,20 +510,20 @@ def extract_weapons(character):
         weapon["crit_attack_range"] = extract_text(
             find_first_child_named(weapon_element, "critatkrange")
         )
-        for damage_element in [
-            el
-            for el in find_first_child_named(weapon_element, "damagelist").childNodes
-            if isinstance(el, xml.dom.minidom.Element)
-        ]:
+        for damage_element in child_elements(
+            find_first_child_named(weapon_element, "damagelist")
+        ):
             weapon["crit_multiplier"] = extract_text(
                 find_first_child_named(damage_element, "critmult")
             )
-            weapon["damage_stat"] = find_first_child_named(damage_element, "stat")
-            weapon["damage_stat_max"] = find_first_child_named(
-                damage_element, "statmax"
+            weapon["damage_stat"] = extract_text(
+                find_first_child_named(damage_element, "stat")
             )
-            weapon["damage_stat_multiplier"] = find_first_child_named(
-                damage_element, "statmult"
+            weapon["damage_stat_max"] = extract_text(
+                find_first_child_named(damage_element, "statmax")
+            )
+            weapon["damage_stat_multiplier"] = extract_text(
+                find_first_child_named(damage_element, "statmult")
             )
             weapon["damage_dice"] = extract_text(
                 find_first_child_named(damage_element, "dice")
@@ -459,55 +559,582 @@ def extract_weapons(character):
 def extract_special_abilities(character):
     return [
         extract_text(find_first_child_named(ability_element, "name"))
-        for ability_element in [
-            el
-            for el in find_first_child_named(character, "specialabilitylist").childNodes
-            if isinstance(el, xml.dom.minidom.Element)
-        ]
+        for ability_element in child_elements(
+            find_first_child_named(character, "specialabilitylist")
+        )
     ]
 
 
+def extract_spell(spell_element):
+    return {
+        "name": extract_text(find_first_child_named(spell_element, "name")),
+        "range": extract_text(find_first_child_named(spell_element, "range")),
+        "save": extract_text(find_first_child_named(spell_element, "save")),
+        "summary": extract_text(
+            find_first_child_named(spell_element, "shortdescription")
+        ),
+        "sr": extract_text(find_first_child_named(spell_element, "sr")),
+        "school": extract_text(find_first_child_named(spell_element, "school"))
+        .split()[0]
+        .lower(),
+        "duration": extract_text(find_first_child_named(spell_element, "duration")),
+        "prepared": extract_text(find_first_child_named(spell_element, "prepared")),
+        "cast": extract_text(find_first_child_named(spell_element, "cast")),
+    }
+
+
+# One entry per spell class (spell set) that has any spells, each with its own
+# DC and its spells by level. Levels without spells are left out. Classes are
+# told apart by the tag of their spell set, since two can share a label.
 def extract_spells(character):
-    spells = {}
+    spell_classes = []
     spellset = find_first_child_named(character, "spellset")
-    first_set = find_first_child_named(spellset, "id-00001")
-    spells["dc"] = extract_text(
-        find_first_child_named(find_first_child_named(first_set, "dc"), "total")
-    )
-    for level in [
-        el
-        for el in find_first_child_named(first_set, "levels").childNodes
-        if isinstance(el, xml.dom.minidom.Element)
-    ]:
-        level_name = extract_text(find_first_child_named(level, "level"))
-        spells[level_name] = []
-        for spell_element in [
-            el
-            for el in find_first_child_named(level, "spells").childNodes
-            if isinstance(el, xml.dom.minidom.Element)
-        ]:
-            spells[level_name].append(
-                {
-                    "name": extract_text(find_first_child_named(spell_element, "name")),
-                    "range": extract_text(
-                        find_first_child_named(spell_element, "range")
-                    ),
-                    "save": extract_text(find_first_child_named(spell_element, "save")),
-                    "summary": extract_text(
-                        find_first_child_named(spell_element, "shortdescription")
-                    ),
-                    "sr": extract_text(find_first_child_named(spell_element, "sr")),
-                    "school": extract_text(
-                        find_first_child_named(spell_element, "school")
+    for spell_set in child_elements(spellset):
+        levels = {}
+        for level in child_elements(find_first_child_named(spell_set, "levels")):
+            spells_element = find_first_child_named(level, "spells")
+            if spells_element is None or len(spells_element) == 0:
+                continue
+            level_name = extract_text(find_first_child_named(level, "level"))
+            levels[level_name] = [
+                extract_spell(spell_element) for spell_element in spells_element
+            ]
+        if not levels:
+            continue
+        if TRACE is not None:
+            TRACE.count("spells", sum(len(spells) for spells in levels.values()))
+        spell_classes.append(
+            {
+                "id": tag_of(spell_set),
+                "name": extract_text(find_first_child_named(spell_set, "label"))
+                or tag_of(spell_set),
+                "dc": extract_text(
+                    find_first_child_named(
+                        find_first_child_named(spell_set, "dc"), "total"
                     )
-                    .split()[0]
-                    .lower(),
-                    "duration": extract_text(
-                        find_first_child_named(spell_element, "duration")
-                    ),
-                }
-            )
-    return spells
+                ),
+                "levels": levels,
+            }
+        )
+    return spell_classes
+
+
+################################################################################
+# Streaming extraction
+################################################################################
+
+# Maps each direct child of <character> to the key it is stored under in the
+# dictionary built by read_character, and the extractor that fills it.
+SECTION_EXTRACTORS = {
+    "name": ("name", extract_name),
+    "deity": ("deity", extract_deity),
+    "level": ("level", extract_level),
+    "classes": ("classes", extract_classes),
+    "race": ("race", extract_race),
+    "age": ("age", extract_age),
+    "appearance": ("appearance", extract_appearance),
+    "gender": ("gender", extract_gender),
+    "height": ("height", extract_height),
+    "weight": ("weight", extract_weight),
+    "abilities": ("abilities", extract_abilities),
+    "languagelist": ("languages", extract_languages),
+    "proficiencylist": ("proficiencies", extract_proficiencies),
+    "saves": ("saves", extract_saves),
+    "alignment": ("alignment", extract_alignment),
+    "size": ("size", extract_size),
+    "hp": ("hp", extract_hp),
+    "initiative": ("initiative", extract_initiative),
+    "speed": ("speed", extract_speed),
+    "ac": ("ac", extract_ac),
+    "attackbonus": ("attack_bonuses", extract_attack_bonuses),
+    "defenses": ("defenses", extract_defenses),
+    "encumbrance": ("encumbrance", extract_encumbrance),
+    "featlist": ("feats", extract_feats),
+    "traitlist": ("traits", extract_traits),
+    "skilllist": ("skills", extract_skills),
+    "inventorylist": ("inventory", extract_inventory),
+    "weaponlist": ("weapons", extract_weapons),
+    "specialabilitylist": ("special_abilities", extract_special_abilities),
+    "spellset": ("spells", extract_spells),
+}
+
+# The tag each section is read from, by the key it is stored under.
+SECTION_TAGS = {key: tag for tag, (key, extractor) in SECTION_EXTRACTORS.items()}
+
+# Sections whose extractor returns None rather than failing when the element
+# is missing from the export.
+TEXT_SECTIONS = [
+    "name",
+    "deity",
+    "level",
+    "race",
+    "age",
+    "appearance",
+    "gender",
+    "height",
+    "weight",
+    "alignment",
+    "size",
+]
+
+
+# A character is a <character> element, as in a single character export, or
+# a record under <charsheet>, where a campaign's db.xml keeps them.
+def is_character_record(element, ancestors):
+    return element.tag == "character" or (
+        bool(ancestors) and ancestors[-1].tag == "charsheet"
+    )
+
+
+# Extracts every section of each character in a file in a single pass,
+# yielding them one character at a time. Each section is handed to its
+# extractor as soon as its closing tag is read and then dropped, as is
+# everything outside the characters, so only one section's subtree is ever
+# held in memory however many characters the file holds.
+def stream_characters(character_file):
+    ancestors = []
+    character = None
+    for event, element in ElementTree.iterparse(character_file, ("start", "end")):
+        if event == "start":
+            if character is None and is_character_record(element, ancestors):
+                character = element
+                character_depth = len(ancestors)
+                sections = dict.fromkeys(TEXT_SECTIONS)
+                seen = set()
+            ancestors.append(element)
+            continue
+        ancestors.pop()
+        if character is not None and element is not character:
+            if len(ancestors) != character_depth + 1:
+                continue
+            # The character element only ever holds the section that just
+            # closed, which lets the extract_* functions run on it unchanged.
+            tag = element.tag
+            if tag in SECTION_EXTRACTORS and tag not in seen:
+                seen.add(tag)
+                key, extractor = SECTION_EXTRACTORS[tag]
+                sections[key] = run_extractor(key, extractor, character)
+            character.remove(element)
+            CHILD_INDEXES.pop(character, None)
+            continue
+        if ancestors:
+            ancestors[-1].remove(element)
+            CHILD_INDEXES.pop(ancestors[-1], None)
+        if element is character:
+            character = None
+            if TRACE is not None:
+                count_sections(sections)
+            yield sections
+
+
+# Extracts every section of the first character in a file. A single export is
+# small enough that building its whole tree in one C call and extracting from
+# that beats handling it event by event, so only campaign databases go through
+# stream_characters.
+def read_character(character_file):
+    root = ElementTree.parse(character_file).getroot()
+    character = root if root.tag == "character" else root.find(".//character")
+    if character is None:
+        character = root.find(".//charsheet/*")
+    sections = dict.fromkeys(TEXT_SECTIONS)
+    if character is None:
+        return sections
+    index = child_index(character)
+    for tag, (key, extractor) in SECTION_EXTRACTORS.items():
+        if tag in index:
+            sections[key] = run_extractor(key, extractor, character)
+    if TRACE is not None:
+        count_sections(sections)
+    return sections
+
+
+def run_extractor(key, extractor, character):
+    if TRACE is None:
+        return extractor(character)
+    with TRACE.span("extract_" + key, "extract"):
+        return extractor(character)
+
+
+def count_sections(sections):
+    TRACE.count("characters")
+    for key in SECTION_TAGS:
+        if sections.get(key) is None:
+            TRACE.count("missing " + key)
+
+
+################################################################################
+# Character model
+################################################################################
+
+
+def parse_number(text):
+    if text is None:
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def parse_numbers(data):
+    return {name: parse_number(value) for name, value in data.items()}
+
+
+@dataclass(slots=True)
+class Ability:
+    name: str
+    score: int
+    bonus: int
+
+
+@dataclass(slots=True)
+class Skill:
+    name: str
+    armorcheckmultiplier: int
+    ranks: int
+    ability_mod: int
+    misc_bonus: int
+    total: int
+    class_skill: int
+
+
+@dataclass(slots=True)
+class Weapon:
+    name: str
+    attacks: int
+    attack_bonus: str
+    crit_attack_range: int
+    crit_multiplier: int
+    damage_dice: str
+    damage_bonus: int
+    damage_type: str
+    range: int | None
+    ammo: int | None
+
+
+@dataclass(slots=True)
+class Spell:
+    name: str
+    level: int
+    school: str
+    save: str | None
+    sr: str | None
+    range: str
+    duration: str
+    summary: str
+    prepared: int | None  # copies prepared
+    cast: int | None  # copies cast since the last rest
+
+
+@dataclass(slots=True)
+class SpellClass:
+    name: str
+    dc: int | None
+    spells: dict
+
+
+@dataclass(slots=True)
+class InventoryItem:
+    name: str
+    type: str | None
+    subtype: str | None
+    cost: str | None
+    weight: int | float | None
+    slot: str | None
+
+
+@dataclass(slots=True)
+class Feat:
+    name: str
+    description: str
+
+
+@dataclass(slots=True)
+class Trait:
+    name: str
+    description: str
+
+
+@dataclass(slots=True)
+class Character:
+    name: str
+    level: int
+    classes: list
+    race: str | None
+    alignment: str | None
+    deity: str | None
+    size: str | None
+    age: str | None
+    appearance: str | None
+    gender: str | None
+    height: str | None
+    weight: str | None
+    abilities: dict
+    initiative: dict
+    hp: dict
+    ac: dict
+    saves: dict
+    attack_bonuses: dict
+    speed: dict
+    defenses: dict
+    encumbrance: dict
+    languages: list
+    proficiencies: list
+    special_abilities: list
+    feats: list
+    traits: list
+    skills: dict
+    inventory: list
+    weapons: list
+    spell_classes: dict  # by spell set tag
+
+    @classmethod
+    def from_sections(cls, sections):
+        return cls(
+            name=sections["name"],
+            level=parse_number(sections["level"]),
+            classes=[
+                (cl["name"], parse_number(cl["level"]))
+                for cl in sections.get("classes", [])
+            ],
+            race=sections["race"],
+            alignment=sections["alignment"],
+            deity=sections["deity"],
+            size=sections["size"],
+            age=sections["age"],
+            appearance=sections["appearance"],
+            gender=sections["gender"],
+            height=sections["height"],
+            weight=sections["weight"],
+            abilities={
+                name: Ability(name, parse_number(score), parse_number(bonus))
+                for name, (score, bonus) in sections.get("abilities", {}).items()
+            },
+            initiative=parse_numbers(sections.get("initiative", {})),
+            hp=parse_numbers(sections.get("hp", {})),
+            ac={
+                part: parse_numbers(data)
+                for part, data in sections.get("ac", {}).items()
+            },
+            saves={
+                name: parse_numbers(data)
+                for name, data in sections.get("saves", {}).items()
+            },
+            attack_bonuses={
+                name: parse_number(data) if name == "base" else parse_numbers(data)
+                for name, data in sections.get("attack_bonuses", {}).items()
+            },
+            speed=parse_numbers(sections.get("speed", {})),
+            defenses={
+                name: parse_numbers(data)
+                for name, data in sections.get("defenses", {}).items()
+            },
+            encumbrance=parse_numbers(sections.get("encumbrance", {})),
+            languages=sections.get("languages", []),
+            proficiencies=sections.get("proficiencies", []),
+            special_abilities=sections.get("special_abilities", []),
+            feats=[
+                Feat(feat["name"], feat["description"])
+                for feat in sections.get("feats", [])
+            ],
+            traits=[
+                Trait(trait["name"], trait["description"])
+                for trait in sections.get("traits", [])
+            ],
+            skills={
+                name: Skill(
+                    name,
+                    parse_number(data["armorcheckmultiplier"]),
+                    parse_number(data["ranks"]),
+                    parse_number(data["ability_mod"]),
+                    parse_number(data["misc_bonus"]),
+                    parse_number(data["total"]),
+                    parse_number(data["class_skill"]),
+                )
+                for name, data in sections.get("skills", {}).items()
+            },
+            inventory=[
+                InventoryItem(
+                    item["name"],
+                    item["type"],
+                    item["subtype"],
+                    item["cost"],
+                    parse_number(item["weight"]),
+                    item["slot"],
+                )
+                for item in sections.get("inventory", [])
+            ],
+            weapons=[
+                Weapon(
+                    weapon["name"],
+                    parse_number(weapon["attacks"]),
+                    weapon["attack_bonus"],
+                    parse_number(weapon["crit_attack_range"]),
+                    parse_number(weapon["crit_multiplier"]),
+                    weapon["damage_dice"],
+                    parse_number(weapon["damage_bonus"]),
+                    weapon["damage_type"],
+                    parse_number(weapon["range"]),
+                    parse_number(weapon["ammo"]),
+                )
+                for weapon in sections.get("weapons", [])
+            ],
+            spell_classes={
+                spell_class["id"]: SpellClass(
+                    spell_class["name"],
+                    parse_number(spell_class["dc"]),
+                    {
+                        int(level): [
+                            Spell(
+                                spell["name"],
+                                int(level),
+                                spell["school"],
+                                spell["save"],
+                                spell["sr"],
+                                spell["range"],
+                                spell["duration"],
+                                spell["summary"],
+                                parse_number(spell["prepared"]),
+                                parse_number(spell["cast"]),
+                            )
+                            for spell in spells
+                        ]
+                        for level, spells in spell_class["levels"].items()
+                    },
+                )
+                for spell_class in sections.get("spells", [])
+            },
+        )
+
+
+def load_character(character_file):
+    if TRACE is not None:
+        with TRACE.span("load_character", "extract"):
+            return Character.from_sections(read_character(character_file))
+    return Character.from_sections(read_character(character_file))
+
+
+def load_characters(character_file):
+    for sections in stream_characters(character_file):
+        yield Character.from_sections(sections)
+
+
+################################################################################
+# Lazy extraction
+################################################################################
+
+# The section each Character field is built from, where the two differ.
+FIELD_SECTIONS = {"spell_classes": "spells"}
+
+
+class StopScan(Exception):
+    pass
+
+
+# Records where each direct child of the first <character> starts and ends in
+# the file, without building any elements. Returns the offsets by tag along
+# with the document's declared encoding.
+def index_sections(character_file):
+    with open(character_file, "rb") as f:
+        data = f.read()
+    parser = xml.parsers.expat.ParserCreate()
+    index = {}
+    encoding = ["utf-8"]
+    depth = 0
+    character_depth = None
+
+    def declaration(version, declared_encoding, standalone):
+        if declared_encoding:
+            encoding[0] = declared_encoding
+
+    def start(name, attributes):
+        nonlocal depth, character_depth
+        depth += 1
+        if character_depth is None:
+            if name == "character":
+                character_depth = depth
+        elif depth == character_depth + 1 and name not in index:
+            index[name] = (parser.CurrentByteIndex, None)
+
+    def end(name):
+        nonlocal depth
+        if character_depth is not None:
+            if depth == character_depth:
+                raise StopScan()
+            if depth == character_depth + 1 and index[name][1] is None:
+                # the byte index points at the end tag (or at the start tag
+                # of an empty element), so the section ends at the next ">"
+                end_index = data.index(b">", parser.CurrentByteIndex) + 1
+                index[name] = (index[name][0], end_index)
+        depth -= 1
+
+    parser.XmlDeclHandler = declaration
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    try:
+        parser.Parse(data, True)
+    except StopScan:
+        pass
+    return index, encoding[0]
+
+
+# A character whose sections are parsed and extracted the first time they are
+# used. Attributes are the same as Character's, so code that only reads a few
+# of them (an initiative tracker reading hp and initiative, say) never pays
+# for the rest of the file.
+class LazyCharacter:
+    def __init__(self, character_file):
+        self.character_file = character_file
+        self.index, self.encoding = index_sections(character_file)
+        self.sections = {}
+        self.fields = {}
+
+    def section(self, key):
+        if key not in self.sections:
+            tag = SECTION_TAGS[key]
+            if tag in self.index:
+                extractor = SECTION_EXTRACTORS[tag][1]
+                self.sections[key] = run_extractor(key, extractor, self.parse(tag))
+            else:
+                self.sections[key] = None
+        return self.sections[key]
+
+    def parse(self, tag):
+        # The extract_* functions look sections up under <character>, so the
+        # section is parsed wrapped in one.
+        start, end = self.index[tag]
+        with open(self.character_file, "rb") as f:
+            f.seek(start)
+            data = f.read(end - start)
+        parser = ElementTree.XMLParser(encoding=self.encoding)
+        parser.feed(b"<character>")
+        parser.feed(data)
+        parser.feed(b"</character>")
+        return parser.close()
+
+    def __getattr__(self, name):
+        if name not in Character.__dataclass_fields__:
+            raise AttributeError(name)
+        if name not in self.fields:
+            key = FIELD_SECTIONS.get(name, name)
+            sections = dict.fromkeys(TEXT_SECTIONS)
+            value = self.section(key)
+            if value is not None:
+                sections[key] = value
+            self.fields[name] = getattr(Character.from_sections(sections), name)
+        return self.fields[name]
+
+    def load(self):
+        sections = dict.fromkeys(TEXT_SECTIONS)
+        for key in SECTION_TAGS:
+            value = self.section(key)
+            if value is not None:
+                sections[key] = value
+        return Character.from_sections(sections)
 
 
 ################################################################################
@@ -516,13 +1143,13 @@ def extract_spells(character):
 
 
 def summarize_save(spell, dc):
-    if spell["save"] is None:
+    if spell.save is None:
         return ""
-    elif "will" in spell["save"].lower():
+    elif "will" in spell.save.lower():
         return "Will {0}".format(dc)
-    elif "reflex" in spell["save"].lower():
+    elif "reflex" in spell.save.lower():
         return "Ref {0}".format(dc)
-    elif "fortitude" in spell["save"].lower():
+    elif "fortitude" in spell.save.lower():
         return "Fort {0}".format(dc)
     else:
         return ""
@@ -544,10 +1171,46 @@ def pluralize(unit, value):
         return unit + "s"
 
 
-def process_equation(duration, lvl):
-    # print("PROCESSING {0}".format(duration))
+# How many times each spell formula that compile_formula could not turn into
+# arithmetic was evaluated; those fall back to showing the text itself.
+UNPARSED_FORMULAS = collections.Counter()
+
+
+@dataclass(slots=True, frozen=True)
+class Formula:
+    text: str
+    parsed: bool
+    constant: int | str = 0
+    unit: str = ""
+    plural_unit: str = ""
+    variable_constant: int = 0
+    # "level", "levels" (one step per `divisor` levels) or "fixed"
+    multiplier_kind: str = "fixed"
+    multiplier: int = 0
+
+    def evaluate(self, level):
+        if not self.parsed:
+            return self.text if self.unit else self.constant
+        if self.unit == "":
+            return self.constant
+        if self.multiplier_kind == "level":
+            multiplier = level
+        elif self.multiplier_kind == "levels":
+            multiplier = level / self.multiplier
+        else:
+            multiplier = self.multiplier
+        value = self.constant + (self.variable_constant * multiplier)
+        return "{0} {1}".format(value, self.unit if value == 1 else self.plural_unit)
+
+
+# Spell texts repeat a handful of formulas, but the render service keeps its
+# workers for good and uploads can carry any text, so the cache is bounded.
+FORMULA_CACHE_SIZE = 1024
+
+
+@functools.lru_cache(maxsize=FORMULA_CACHE_SIZE)
+def compile_formula(duration):
     local_duration = duration.lower()
-    level = int(lvl)
 
     if local_duration.endswith("(d)"):
         local_duration = local_duration[:-3]
@@ -569,7 +1232,6 @@ def process_equation(duration, lvl):
         local_duration = (
             terms[0].strip() if contains_number(terms[0]) else terms[1].strip()
         )
-        # print("--> {0}".format(local_duration))
 
     # check if it's a compound term
     plus_index = local_duration.find("+")
@@ -583,53 +1245,68 @@ def process_equation(duration, lvl):
         base_term = local_duration
         variable_term = "0"
 
-    # process the variable part
-    if variable_term != "0":
-        per_index = variable_term.find("/")  # we know it's there
-        variable_item = variable_term[:per_index].strip()
-        if variable_item.find(" ") > -1:
-            variable_constant, variable_unit = variable_item.split()
+    try:
+        # process the variable part
+        if variable_term != "0":
+            per_index = variable_term.find("/")  # we know it's there
+            variable_item = variable_term[:per_index].strip()
+            if variable_item.find(" ") > -1:
+                variable_constant, variable_unit = variable_item.split()
+            else:
+                variable_constant = variable_item
+                variable_unit = ""
+            multiplier = variable_term[per_index + 1 :].strip()
         else:
-            variable_constant = variable_item
+            variable_constant = "0"
             variable_unit = ""
-        multiplier = variable_term[per_index + 1 :].strip()
-    else:
-        variable_constant = "0"
-        variable_unit = ""
-        multiplier = "0"
+            multiplier = "0"
 
-    if base_term.find(" ") > -1:
-        constant, unit = base_term.split()[-2:]
-    else:
-        constant = base_term
-        unit = ""
+        if base_term.find(" ") > -1:
+            constant, unit = base_term.split()[-2:]
+        else:
+            constant = base_term
+            unit = ""
+
+        # constant + variable_constant * multiplier
+        variable_constant = int(variable_constant)
+        if multiplier == "level":
+            multiplier_kind = "level"
+            multiplier = 0
+        elif multiplier.endswith("levels"):
+            multiplier_kind = "levels"
+            multiplier = int(multiplier.split()[0].strip())
+        else:
+            multiplier_kind = "fixed"
+            multiplier = int(multiplier)
+    except ValueError:
+        return Formula(duration, parsed=False, constant=duration, unit="")
+    if unit == "":
+        unit = variable_unit
 
-    # constant + variable_constant * multiplier
     try:
         constant = int(constant)
-    except:
-        pass
-    variable_constant = int(variable_constant)
-    if multiplier == "level":
-        multiplier = level
-    elif multiplier.endswith("levels"):
-        multiplier = level / int(multiplier.split()[0].strip())
-    else:
-        multiplier = int(multiplier)
-    if unit == "":
-        unit = variable_unit
+    except ValueError:
+        # Plain text such as "touch" or "instantaneous" is shown as it is.
+        return Formula(duration, parsed=False, constant=constant, unit=unit)
+    return Formula(
+        duration,
+        parsed=True,
+        constant=constant,
+        unit=unit,
+        plural_unit=pluralize(unit, 2) if unit else "",
+        variable_constant=variable_constant,
+        multiplier_kind=multiplier_kind,
+        multiplier=multiplier,
+    )
 
-    # print(
-    #     "CONSTANT: {0}, UNIT: {1}, VARIABLE_CONSTANT: {2}, MULTIPLIER: {3}".format(
-    #         constant, unit, variable_constant, multiplier
-    #     )
-    # )
 
-    if unit == "":
-        return constant
-    else:
-        value = constant + (variable_constant * multiplier)
-        return str("{0} {1}".format(value, pluralize(unit, value)))
+def process_equation(duration, lvl):
+    formula = compile_formula(duration)
+    if not formula.parsed:
+        UNPARSED_FORMULAS[duration] += 1
+        if TRACE is not None:
+            TRACE.count("formula fallbacks")
+    return formula.evaluate(int(lvl))
 
 
 def damage_sign_of(value):
@@ -648,618 +1325,958 @@ def abs_value_of(value):
         return abs(value)
 
 
-def dump(character_file):
-    dom_tree = xml.dom.minidom.parse(character_file)
-    character = dom_tree.documentElement.getElementsByTagName("character")[0]
-
-    print("Name: {0}".format(extract_name(character)))
-
-    character_level = extract_level(character)
-    print("Level: {0}".format(character_level))
+# Marks a DumpNode that has no value, since None is a value worth printing.
+NO_VALUE = object()
 
-    print("Classes:")
-    for char_class in extract_classes(character):
-        print("  {0} {1}".format(char_class["name"], char_class["level"]))
 
-    print("Race: {0}".format(extract_race(character)))
+# A section of dump output: a label with either a value, children, or neither
+# (a plain line of text).
+@dataclass(slots=True)
+class DumpNode:
+    label: str
+    value: object = NO_VALUE
+    children: list = dataclasses.field(default_factory=list)
 
-    print("Initiative:")
-    init_data = extract_initiative(character)
-    for init_name in INIT_TYPES:
-        print("  {0}: {1}".format(init_name.capitalize(), init_data[init_name]))
 
-    print("HP:")
-    hp_data = extract_hp(character)
-    for hp_name in HP_TYPES:
-        print("  {0}: {1}".format(hp_name.capitalize(), hp_data[hp_name]))
+def value_nodes(data, names=None, label=str.capitalize):
+    return [DumpNode(label(name), data[name]) for name in (names or list(data.keys()))]
 
-    print("Alignment: {0}".format(extract_alignment(character)))
 
-    print("Deity: {0}".format(extract_deity(character)))
+def dump_value(title, attribute):
+    return lambda character: DumpNode(title, getattr(character, attribute))
 
-    print("Size: {0}".format(extract_size(character)))
 
-    print("Age: {0}".format(extract_age(character)))
+def dump_classes(character):
+    return DumpNode(
+        "Classes",
+        children=[
+            DumpNode("{0} {1}".format(class_name, class_level))
+            for class_name, class_level in character.classes
+        ],
+    )
 
-    print("Appearance: {0}".format(extract_appearance(character)))
 
-    print("Gender: {0}".format(extract_gender(character)))
+def dump_abilities(character):
+    abilities = character.abilities
+    return DumpNode(
+        "Abilities",
+        children=[
+            DumpNode(
+                name.capitalize(),
+                "{0} bonus: {1}".format(abilities[name].score, abilities[name].bonus),
+            )
+            for name in ABILITY_NAMES
+        ],
+    )
 
-    print("Height: {0}".format(extract_height(character)))
 
-    print("Weight: {0}".format(extract_weight(character)))
+def dump_saves(character):
+    saves = character.saves
+    return DumpNode(
+        "Saves",
+        children=[
+            DumpNode(save_name.capitalize(), children=value_nodes(saves[save_name]))
+            for save_name in SAVE_NAMES
+        ],
+    )
 
-    print("Speed:")
-    speed_data = extract_speed(character)
-    for name, value in speed_data.items():
-        print("  {0}: {1}".format(name.capitalize(), value))
 
-    print("Abilities:")
-    abilities = extract_abilities(character)
-    for name in ABILITY_NAMES:
-        print(
-            "  {0}: {1} bonus: {2}".format(
-                name.capitalize(), abilities[name][0], abilities[name][1]
+def dump_attack_bonuses(character):
+    node = DumpNode("Attack Bonuses")
+    for bonus_name, bonus_data in character.attack_bonuses.items():
+        if bonus_name == "base":
+            node.children.append(DumpNode("Base", bonus_data))
+        else:
+            node.children.append(
+                DumpNode(bonus_name.capitalize(), children=value_nodes(bonus_data))
             )
-        )
+    return node
 
-    ac_data = extract_ac(character)
-    print("AC Totals:")
-    for ac_name in AC_TYPES:
-        print("  {0}: {1}".format(ac_name.capitalize(), ac_data["totals"][ac_name]))
-    print("AC Sources:")
-    for ac_name in AC_SOURCES:
-        print("  {0}: {1}".format(ac_name.capitalize(), ac_data["sources"][ac_name]))
 
-    print("Languages:")
-    for l in extract_languages(character):
-        print("  {0}".format(l))
+def dump_defenses(character):
+    return DumpNode(
+        "Defenses",
+        children=[
+            DumpNode(defense_name.capitalize(), children=value_nodes(defense_data))
+            for defense_name, defense_data in character.defenses.items()
+        ],
+    )
 
-    print("Proficiencies:")
-    for l in extract_proficiencies(character):
-        print("  {0}".format(l))
 
-    print("Saves:")
-    saves = extract_saves(character)
-    for save_name in SAVE_NAMES:
-        print("  {0}".format(save_name.capitalize()))
-        for name, value in saves[save_name].items():
-            print("    {0}: {1}".format(name.capitalize(), value))
+def dump_skills(character):
+    return DumpNode(
+        "Skills",
+        children=[
+            DumpNode(
+                skill.name,
+                children=[
+                    DumpNode("armorcheckmultiplier", skill.armorcheckmultiplier),
+                    DumpNode("ranks", skill.ranks),
+                    DumpNode("ability_mod", skill.ability_mod),
+                    DumpNode("misc_bonus", skill.misc_bonus),
+                    DumpNode("total", skill.total),
+                    DumpNode("class_skill", skill.class_skill),
+                ],
+            )
+            for skill in character.skills.values()
+        ],
+    )
 
-    attack_bonuses = extract_attack_bonuses(character)
-    print("Attack Bonuses:")
-    for bonus_name, bonus_data in attack_bonuses.items():
-        if bonus_name == "base":
-            print("  Base: {0}".format(bonus_data))
+
+def dump_inventory(character):
+    node = DumpNode("Inventory")
+    for item in character.inventory:
+        item_node = DumpNode(
+            item.name,
+            children=[
+                DumpNode("type", item.type),
+                DumpNode("cost", item.cost),
+                DumpNode("weight", item.weight),
+            ],
+        )
+        if item.slot:
+            item_node.children.append(DumpNode("slot", item.slot))
+        node.children.append(item_node)
+    return node
+
+
+# A node per spell class, or a single empty one for a character with none.
+def dump_spells(character):
+    spell_classes = list(character.spell_classes.values())
+    nodes = []
+    for spell_class in spell_classes or [SpellClass(None, None, {})]:
+        if len(spell_classes) > 1:
+            node = DumpNode("{0} Spells".format(spell_class.name))
         else:
-            print("  {0}".format(bonus_name.capitalize()))
-            for name, value in bonus_data.items():
-                print("    {0}: {1}".format(name.capitalize(), value))
-
-    defenses = extract_defenses(character)
-    print("Defenses:")
-    for defense_name, defense_data in defenses.items():
-        print("  {0}".format(defense_name.capitalize()))
-        for name, value in defense_data.items():
-            print("    {0}: {1}".format(name.capitalize(), value))
-
-    print("Encumbrance:")
-    encumbrance_data = extract_encumbrance(character)
-    for name, value in encumbrance_data.items():
-        print("  {0}: {1}".format(name.capitalize(), value))
-
-    print("Feats:")
-    feat_data = extract_feats(character)
-    for feat in feat_data:
-        print("  {0} - {1}".format(feat["name"], feat["description"]))
-
-    print("Traits:")
-    trait_data = extract_traits(character)
-    for trait in trait_data:
-        print("  {0} - {1}".format(trait["name"], trait["description"]))
-
-    print("Skills:")
-    skill_data = extract_skills(character)
-    for skill, data in skill_data.items():
-        print("  {0}".format(skill))
-        for name, value in data.items():
-            print("    {0}: {1}".format(name, value))
-
-    print("Inventory:")
-    for item in extract_inventory(character):
-        print("  {0}".format(item["name"]))
-        print("    type: {0}".format(item["type"]))
-        print("    cost: {0}".format(item["cost"]))
-        print("    weight: {0}".format(item["weight"]))
-        if item["slot"]:
-            print("    slot: {0}".format(item["slot"]))
-
-    print("Special Abilities:")
-    for ability in extract_special_abilities(character):
-        print("  {0}".format(ability))
-
-    print("Spells:")
-    spell_data = extract_spells(character)
-    for level in range(0, 10):
-        print("  Level {0}".format(level))
-        for spell in spell_data[str(level)]:
-            print("    {0}".format(spell["name"]))
-            print("      School: {0}".format(spell["school"]))
-            print("      Save: {0}".format(summarize_save(spell, spell_data["dc"])))
-            print("      SR?: {0}".format(spell["sr"].lower() if spell["sr"] else ""))
-            print(
-                "      Range: {0}".format(
-                    process_equation(spell["range"], character_level)
-                )
-            )
-            print(
-                "      Duration: {0}".format(
-                    process_equation(spell["duration"], character_level)
+            node = DumpNode("Spells")
+        for level in range(0, 10):
+            level_node = DumpNode("Level {0}".format(level))
+            for spell in spell_class.spells.get(level, ()):
+                level_node.children.append(
+                    DumpNode(
+                        spell.name,
+                        children=[
+                            DumpNode("School", spell.school),
+                            DumpNode("Save", summarize_save(spell, spell_class.dc)),
+                            DumpNode("SR?", spell.sr.lower() if spell.sr else ""),
+                            DumpNode(
+                                "Range", process_equation(spell.range, character.level)
+                            ),
+                            DumpNode(
+                                "Duration",
+                                process_equation(spell.duration, character.level),
+                            ),
+                            DumpNode("Summary", spell.summary),
+                        ],
+                    )
                 )
-            )
-            print("      Summary: {0}".format(spell["summary"]))
-
-    print("Weapons:")
-    for weapon in extract_weapons(character):
-        print("  {0}".format(weapon["name"]))
-        print("    Attack Bonus: {0}".format(weapon["attack_bonus"]))
-        damage_bonus = int(weapon["damage_bonus"])
-        print(
-            "    Damage: {0}{1}{2}".format(
-                weapon["damage_dice"],
-                damage_sign_of(damage_bonus),
-                abs_value_of(damage_bonus),
-            )
+            node.children.append(level_node)
+        nodes.append(node)
+    return nodes
+
+
+def dump_weapons(character):
+    node = DumpNode("Weapons")
+    for weapon in character.weapons:
+        weapon_node = DumpNode(
+            weapon.name,
+            children=[
+                DumpNode("Attack Bonus", weapon.attack_bonus),
+                DumpNode(
+                    "Damage",
+                    "{0}{1}{2}".format(
+                        weapon.damage_dice,
+                        damage_sign_of(weapon.damage_bonus),
+                        abs_value_of(weapon.damage_bonus),
+                    ),
+                ),
+                DumpNode("Crit Range", weapon.crit_attack_range),
+                DumpNode("Crit Multipler", weapon.crit_multiplier),
+                DumpNode("Type", weapon.damage_type),
+            ],
         )
-        print("    Crit Range: {0}".format(weapon["crit_attack_range"]))
-        print("    Crit Multipler: {0}".format(weapon["crit_multiplier"]))
-        print("    Type: {0}".format(weapon["damage_type"]))
-        if weapon["range"]:
-            print("    Range: {0}".format(weapon["range"]))
-        if weapon["ammo"]:
-            print("    Ammo: {0}".format(weapon["ammo"]))
+        if weapon.range is not None:
+            weapon_node.children.append(DumpNode("Range", weapon.range))
+        if weapon.ammo is not None:
+            weapon_node.children.append(DumpNode("Ammo", weapon.ammo))
+        node.children.append(weapon_node)
+    return node
+
+
+# The sections dump can write, in the order it writes them.
+DUMP_SECTIONS = {
+    "name": dump_value("Name", "name"),
+    "level": dump_value("Level", "level"),
+    "classes": dump_classes,
+    "race": dump_value("Race", "race"),
+    "initiative": lambda character: DumpNode(
+        "Initiative", children=value_nodes(character.initiative, INIT_TYPES)
+    ),
+    "hp": lambda character: DumpNode(
+        "HP", children=value_nodes(character.hp, HP_TYPES)
+    ),
+    "alignment": dump_value("Alignment", "alignment"),
+    "deity": dump_value("Deity", "deity"),
+    "size": dump_value("Size", "size"),
+    "age": dump_value("Age", "age"),
+    "appearance": dump_value("Appearance", "appearance"),
+    "gender": dump_value("Gender", "gender"),
+    "height": dump_value("Height", "height"),
+    "weight": dump_value("Weight", "weight"),
+    "speed": lambda character: DumpNode("Speed", children=value_nodes(character.speed)),
+    "abilities": dump_abilities,
+    "ac": lambda character: [
+        DumpNode("AC Totals", children=value_nodes(character.ac["totals"], AC_TYPES)),
+        DumpNode(
+            "AC Sources", children=value_nodes(character.ac["sources"], AC_SOURCES)
+        ),
+    ],
+    "languages": lambda character: DumpNode(
+        "Languages", children=[DumpNode(l) for l in character.languages]
+    ),
+    "proficiencies": lambda character: DumpNode(
+        "Proficiencies", children=[DumpNode(l) for l in character.proficiencies]
+    ),
+    "saves": dump_saves,
+    "attack_bonuses": dump_attack_bonuses,
+    "defenses": dump_defenses,
+    "encumbrance": lambda character: DumpNode(
+        "Encumbrance", children=value_nodes(character.encumbrance)
+    ),
+    "feats": lambda character: DumpNode(
+        "Feats",
+        children=[
+            DumpNode("{0} - {1}".format(feat.name, feat.description))
+            for feat in character.feats
+        ],
+    ),
+    "traits": lambda character: DumpNode(
+        "Traits",
+        children=[
+            DumpNode("{0} - {1}".format(trait.name, trait.description))
+            for trait in character.traits
+        ],
+    ),
+    "skills": dump_skills,
+    "inventory": dump_inventory,
+    "special_abilities": lambda character: DumpNode(
+        "Special Abilities",
+        children=[DumpNode(ability) for ability in character.special_abilities],
+    ),
+    "spells": dump_spells,
+    "weapons": dump_weapons,
+}
+
+
+def write_text(node, out, depth=0):
+    indent = "  " * depth
+    if node.value is not NO_VALUE:
+        out.write("{0}{1}: {2}\n".format(indent, node.label, node.value))
+    elif depth == 0:
+        out.write("{0}:\n".format(node.label))
+    else:
+        out.write("{0}{1}\n".format(indent, node.label))
+    for child in node.children:
+        write_text(child, out, depth + 1)
+
+
+def write_markdown(node, out, depth=0):
+    if depth == 0:
+        if node.value is not NO_VALUE:
+            out.write("**{0}:** {1}\n\n".format(node.label, node.value))
+            return
+        out.write("## {0}\n\n".format(node.label))
+    else:
+        indent = "  " * (depth - 1)
+        if node.value is not NO_VALUE:
+            out.write("{0}- {1}: {2}\n".format(indent, node.label, node.value))
+        else:
+            out.write("{0}- {1}\n".format(indent, node.label))
+    for child in node.children:
+        write_markdown(child, out, depth + 1)
+    if depth == 0:
+        out.write("\n")
+
+
+# Each section becomes its own table, headed by its title: a row per entry,
+# with the entry's values as columns. Entries grouped under a heading (the
+# spell levels) carry it in a "group" column.
+def write_csv(node, out):
+    rows = []
+    if node.value is not NO_VALUE:
+        rows.append({"name": node.label, "value": node.value})
+    grouped = any(
+        grandchild.children for child in node.children for grandchild in child.children
+    )
+    for child in node.children:
+        if grouped:
+            rows.extend(csv_row(entry, group=child.label) for entry in child.children)
+        else:
+            rows.append(csv_row(child))
+    columns = list(dict.fromkeys(column for row in rows for column in row))
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow([node.label])
+    if rows:
+        writer.writerow(columns)
+        writer.writerows([row.get(column, "") for column in columns] for row in rows)
+    out.write("\n")
+
+
+def csv_row(node, group=None):
+    row = {} if group is None else {"group": group}
+    row["name"] = node.label
+    if node.value is not NO_VALUE:
+        row["value"] = node.value
+    for child in node.children:
+        row[child.label] = child.value if child.value is not NO_VALUE else ""
+    return row
+
+
+DUMP_FORMATS = {"text": write_text, "markdown": write_markdown, "csv": write_csv}
+
+
+# Writes the character's sections to out (stdout by default) in one write.
+# Given a list of section names, only those are written, and only the parts of
+# the file they need are parsed.
+# character_file may also be a Character that has already been loaded.
+def dump(character_file, out=None, format="text", sections=None):
+    if sections is not None:
+        unknown = [section for section in sections if section not in DUMP_SECTIONS]
+        if unknown:
+            raise ValueError("unknown dump sections: {0}".format(", ".join(unknown)))
+    if isinstance(character_file, Character):
+        character = character_file
+    elif sections is None:
+        character = load_character(character_file)
+    else:
+        character = LazyCharacter(character_file)
+    if sections is None:
+        sections = list(DUMP_SECTIONS)
+    write = DUMP_FORMATS[format]
+    buffer = io.StringIO()
+    for section in sections:
+        nodes = DUMP_SECTIONS[section](character)
+        for node in nodes if isinstance(nodes, list) else [nodes]:
+            write(node, buffer)
+    (sys.stdout if out is None else out).write(buffer.getvalue())
 
 
 # dump("Simone_with_personal.xml")
 
 
-def extract_sub_skill(skill):
-    op_index = skill.find("(")
-    cp_index = skill.find(")")
-    return skill[op_index + 1 : cp_index]
+################################################################################
+# Data export
+################################################################################
 
+# Bump whenever the Character model changes shape, so cached exports made by
+# an older version are not read back.
+EXPORT_VERSION = 4
+EXPORT_FORMATS = {"json": ".json", "msgpack": ".msgpack"}
 
-def partition(l, n):
-    for i in range(0, len(l), n):
-        yield l[i : i + n]
 
+def character_data(character):
+    return dataclasses.asdict(character)
 
-def to_pdf(filename):
-    dom_tree = xml.dom.minidom.parse(filename)
-    character = dom_tree.documentElement.getElementsByTagName("character")[0]
 
-    character_name = extract_name(character)
-    character_level = extract_level(character)
+def character_from_data(data):
+    fields = dict(data)
+    fields["classes"] = [tuple(cl) for cl in data["classes"]]
+    fields["abilities"] = {
+        name: Ability(**ability) for name, ability in data["abilities"].items()
+    }
+    fields["skills"] = {name: Skill(**skill) for name, skill in data["skills"].items()}
+    fields["feats"] = [Feat(**feat) for feat in data["feats"]]
+    fields["traits"] = [Trait(**trait) for trait in data["traits"]]
+    fields["inventory"] = [InventoryItem(**item) for item in data["inventory"]]
+    fields["weapons"] = [Weapon(**weapon) for weapon in data["weapons"]]
+    # JSON turns the spell levels into strings
+    fields["spell_classes"] = {
+        key: SpellClass(
+            spell_class["name"],
+            spell_class["dc"],
+            {
+                int(level): [Spell(**spell) for spell in spells]
+                for level, spells in spell_class["spells"].items()
+            },
+        )
+        for key, spell_class in data["spell_classes"].items()
+    }
+    return Character(**fields)
+
+
+def export_character(character, format="json"):
+    data = character_data(character)
+    if format == "json":
+        return json.dumps(data).encode("utf-8")
+    if format == "msgpack":
+        if msgpack is None:
+            raise RuntimeError("the msgpack format needs the msgpack package")
+        return msgpack.packb(data)
+    raise ValueError("unknown export format {0!r}".format(format))
+
+
+def import_character(blob, format="json"):
+    if format == "json":
+        return character_from_data(json.loads(blob))
+    if format == "msgpack":
+        if msgpack is None:
+            raise RuntimeError("the msgpack format needs the msgpack package")
+        return character_from_data(msgpack.unpackb(blob, strict_map_key=False))
+    raise ValueError("unknown export format {0!r}".format(format))
+
+
+def write_export(character, output_filename, format="json"):
+    with open(output_filename, "wb") as output_file:
+        output_file.write(export_character(character, format))
+    return output_filename
+
+
+EXPORT_CACHE_STATS = collections.Counter()
+
+
+# Loads a character through a cache of exports named after the hash of the
+# XML, so tools that only need the data skip parsing it again. Entries are
+# written to a temporary file and renamed, so readers never see half of one;
+# an entry that is missing or cannot be read back is rebuilt from the XML.
+def cached_character(filename, cache_dir, format="json"):
+    with open(filename, "rb") as character_file:
+        xml_data = character_file.read()
+    digest = hashlib.sha256(xml_data)
+    digest.update("export-{0}".format(EXPORT_VERSION).encode("ascii"))
+    cache_filename = os.path.join(
+        cache_dir, digest.hexdigest() + EXPORT_FORMATS[format]
+    )
+    try:
+        with open(cache_filename, "rb") as cache_file:
+            character = import_character(cache_file.read(), format)
+    except Exception:
+        pass
+    else:
+        EXPORT_CACHE_STATS["hits"] += 1
+        return character
+    EXPORT_CACHE_STATS["misses"] += 1
+    character = load_character(io.BytesIO(xml_data))
+    os.makedirs(cache_dir, exist_ok=True)
+    temporary_filename = "{0}.{1}.tmp".format(cache_filename, os.getpid())
+    with open(temporary_filename, "wb") as cache_file:
+        cache_file.write(export_character(character, format))
+    os.replace(temporary_filename, cache_filename)
+    return character
 
-    # Character page
-    packet = io.BytesIO()
 
-    # create a new PDF with Reportlab
-    can = canvas.Canvas(packet, pagesize=letter)
+################################################################################
+# Character diff
+################################################################################
 
-    # Character page
 
-    # basic
-    can.drawString(50, 698, character_name)
-    can.setFontSize(size=10)
-    can.drawString(175, 676, extract_race(character))
-    can.drawString(50, 655, extract_alignment(character))
-    can.drawString(175, 655, extract_deity(character))
+@dataclass(slots=True)
+class Change:
+    path: str
+    kind: str  # "added", "removed" or "changed"
+    old: object = None
+    new: object = None
+
+    def __str__(self):
+        if self.kind == "added":
+            return "+ {0}".format(self.path)
+        if self.kind == "removed":
+            return "- {0}".format(self.path)
+        return "~ {0}: {1} -> {2}".format(self.path, self.old, self.new)
+
+
+# How the entries of each list section are matched up between two exports,
+# since Fantasy Grounds is free to reorder them.
+DIFF_KEYS = {
+    "classes": lambda cl: cl[0],
+    "languages": lambda language: language,
+    "proficiencies": lambda proficiency: proficiency,
+    "special_abilities": lambda ability: ability,
+    "feats": lambda feat: feat["name"],
+    "traits": lambda trait: trait["name"],
+    "inventory": lambda item: item["name"],
+    "weapons": lambda weapon: weapon["name"],
+    "spells": lambda spell: "{0}/level {1}/{2}".format(
+        spell["class"], spell["level"], spell["name"]
+    ),
+}
+
+
+def keyed(entries, key):
+    # Entries that share a key (two daggers, say) are told apart by a count.
+    index = {}
+    for entry in entries:
+        name = str(key(entry))
+        if name in index:
+            count = 2
+            while "{0} #{1}".format(name, count) in index:
+                count += 1
+            name = "{0} #{1}".format(name, count)
+        index[name] = entry
+    return index
+
+
+def diff_values(path, old, new, changes, key=None):
+    if isinstance(old, dict) and isinstance(new, dict):
+        for name, value in old.items():
+            child = "{0}.{1}".format(path, name) if path else str(name)
+            if name not in new:
+                changes.append(Change(child, "removed", old=value))
+            else:
+                diff_values(child, value, new[name], changes)
+        for name, value in new.items():
+            if name not in old:
+                child = "{0}.{1}".format(path, name) if path else str(name)
+                changes.append(Change(child, "added", new=value))
+    elif isinstance(old, list) and isinstance(new, list) and key is not None:
+        diff_values(path, keyed(old, key), keyed(new, key), changes)
+    elif old != new:
+        changes.append(Change(path, "changed", old, new))
+
+
+# Lists what changed from one version of a character to another, matching
+# list entries by name so reordering is not reported. Runs in time linear in
+# the size of the characters.
+def diff_characters(old, new):
+    old_data, new_data = character_data(old), character_data(new)
+    for data in (old_data, new_data):
+        spell_classes = data.pop("spell_classes")
+        data["spell_classes"] = {
+            key: {"name": spell_class["name"], "dc": spell_class["dc"]}
+            for key, spell_class in spell_classes.items()
+        }
+        data["spells"] = [
+            dict(spell, **{"class": key})
+            for key, spell_class in spell_classes.items()
+            for spells in spell_class["spells"].values()
+            for spell in spells
+        ]
+    changes = []
+    for name in old_data:
+        diff_values(name, old_data[name], new_data[name], changes, DIFF_KEYS.get(name))
+    return changes
+
+
+def diff_files(old_filename, new_filename):
+    return diff_characters(load_character(old_filename), load_character(new_filename))
+
+
+# Diffs the exports that two directories have in common, by file name, in a
+# process pool. Yields (old, new, changes) as each finishes, with changes set
+# to None for a file only one side has and to the error for one that failed.
+def diff_rosters(old_dir, new_dir, workers=None):
+    old_files = {os.path.basename(f): f for f in expand_inputs([old_dir])}
+    new_files = {os.path.basename(f): f for f in expand_inputs([new_dir])}
+    for name in sorted(old_files.keys() - new_files.keys()):
+        yield old_files[name], None, None
+    for name in sorted(new_files.keys() - old_files.keys()):
+        yield None, new_files[name], None
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(diff_files, old_files[name], new_files[name]): name
+            for name in sorted(old_files.keys() & new_files.keys())
+        }
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                changes = future.result()
+            except Exception as e:
+                changes = "{0}: {1}".format(type(e).__name__, e)
+            yield old_files[name], new_files[name], changes
 
-    # Initiative
-    initiative = extract_initiative(character)
-    can.drawString(315, 703, initiative["abilitymod"])
-    if initiative["misc"] != "0":
-        can.drawString(450, 703, initiative["misc"])
-    can.drawString(540, 715, initiative["total"])
 
-    # Classes
-    for i, cl in enumerate(extract_classes(character)):
-        can.drawString(50, 615 - (i * 15), cl["name"])
-        can.drawString(275, 615 - (i * 15), cl["level"])
+################################################################################
+# Batch rendering
+################################################################################
 
-    # Speeds
-    can.drawString(395, 644, extract_speed(character)["total"])
 
-    # Ability Scores
-    count = 0
-    for name, ability in extract_abilities(character).items():
-        can.setFont("Helvetica-Bold", 18)
-        if len(ability[0]) == 1:
-            can.drawString(225, 508 - (count * 35), ability[0])
-        else:
-            can.drawString(220, 508 - (count * 35), ability[0])
-        can.setFont("Helvetica", 10)
-        can.drawString(260, 512 - (count * 35), ability[1])
-        count += 1
-
-    # Armor Class
-    ac = extract_ac(character)
-    can.setFont("Helvetica-Bold", 18)
-    can.drawString(357, 293, ac["totals"]["general"])
-    can.setFont("Helvetica", 10)
-    can.drawString(225, 283, ac["totals"]["flatfooted"])
-    can.drawString(270, 283, ac["totals"]["touch"])
-    can.drawString(315, 283, ac["totals"]["cmd"])
-
-    # HP
-    hp = extract_hp(character)
-    can.setFont("Helvetica-Bold", 18)
-    can.drawString(535, 293, hp["total"])
-
-    # Saves
-    saves = extract_saves(character)
-    can.setFont("Helvetica-Bold", 18)
-    for i, save_name in enumerate(SAVE_NAMES):
-        value = saves[save_name]["total"]
-        if len(value) == 1:
-            can.drawString(363, 162 - (i * 39), value)
+# Yields (label, character, error) for every character in filenames, with
+# error set in place of the character when it cannot be read. With campaign
+# set, each file is a campaign database holding any number of characters,
+# read one at a time and labelled by their position in the file.
+def iter_characters(filenames, campaign=False, load=load_character):
+    for filename in filenames:
+        if not campaign:
+            try:
+                yield filename, load(filename), None
+            except Exception as e:
+                yield filename, None, "{0}: {1}".format(type(e).__name__, e)
+            continue
+        count = 0
+        try:
+            for sections in stream_characters(filename):
+                count += 1
+                label = "{0}#{1}".format(filename, count)
+                try:
+                    character = Character.from_sections(sections)
+                except Exception as e:
+                    yield label, None, "{0}: {1}".format(type(e).__name__, e)
+                else:
+                    yield label, character, None
+        except Exception as e:
+            label = "{0}#{1}".format(filename, count + 1)
+            yield label, None, "{0}: {1}".format(type(e).__name__, e)
+
+
+def expand_inputs(paths):
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(sorted(glob.glob(os.path.join(path, "*.xml"))))
+        elif glob.has_magic(path):
+            filenames.extend(sorted(glob.glob(path)))
         else:
-            can.drawString(358, 162 - (i * 39), value)
-
-    # Offense Page
-    can.showPage()
-
-    ab = extract_attack_bonuses(character)
-
-    # Attack bonuses
-
-    can.setFont("Helvetica-Bold", 18)
-    can.drawString(510, 695, ab["base"])
-
-    can.setFont("Helvetica", 10)
-    can.drawString(215, 662, ab["base"])
-    can.drawString(262, 662, ab["melee"]["abilitymod"])
-    can.drawString(310, 662, ab["melee"]["size"])
-    can.drawString(360, 662, ab["melee"]["misc"])
-    can.setFont("Helvetica-Bold", 18)
-    can.drawString(410, 660, ab["melee"]["total"])
-
-    can.setFont("Helvetica", 10)
-    can.drawString(215, 620, ab["base"])
-    can.drawString(262, 620, ab["ranged"]["abilitymod"])
-    can.drawString(310, 620, ab["ranged"]["size"])
-    can.drawString(360, 620, ab["ranged"]["misc"])
-    can.setFont("Helvetica-Bold", 18)
-    can.drawString(410, 619, ab["ranged"]["total"])
-
-    can.setFont("Helvetica", 10)
-    can.drawString(215, 580, ab["base"])
-    can.drawString(262, 580, ab["grapple"]["abilitymod"])
-    can.drawString(310, 580, ab["grapple"]["size"])
-    can.drawString(360, 580, ab["grapple"]["misc"])
-    can.setFont("Helvetica-Bold", 18)
-    can.drawString(410, 578, ab["grapple"]["total"])
-
-    can.setFont("Helvetica", 10)
-
-    # Attacks
-
-    count = 0
-    for weapon in extract_weapons(character):
-        can.drawString(40, 510 - (count * 53.5), weapon["name"])
-        can.drawString(180, 505 - (count * 53.5), weapon["attack_bonus"])
-        damage_bonus = int(weapon["damage_bonus"])
-        can.drawString(
-            260,
-            505 - (count * 53.5),
-            "{0}{1}{2}".format(
-                weapon["damage_dice"],
-                damage_sign_of(damage_bonus),
-                abs_value_of(damage_bonus),
-            ),
+            filenames.append(path)
+    return filenames
+
+
+# Outputs are named after the input they come from rather than the character,
+# so two exports of the same character do not overwrite each other: the third
+# character of campaign "db.xml" is labelled "db.xml#3" and written as "db-3".
+def output_stem(label):
+    filename, _, record = label.partition("#")
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    return "{0}-{1}".format(stem, record) if record else stem
+
+
+# Records label as the writer of its output in claimed, or returns the error
+# to report when an earlier input of the same batch already writes that output.
+def claim_output(claimed, label):
+    stem = os.path.normcase(output_stem(label))
+    if stem in claimed:
+        return "output {0} would overwrite the output of {1}".format(
+            output_stem(label), claimed[stem]
         )
-        can.drawString(350, 505 - (count * 53.5), weapon["crit_attack_range"])
-        can.drawString(395, 505 - (count * 53.5), weapon["crit_multiplier"])
-        can.drawString(438, 505 - (count * 53.5), weapon["damage_type"])
-        if weapon["range"]:
-            can.drawString(480, 505 - (count * 53.5), weapon["range"])
-        if weapon["ammo"]:
-            can.drawString(525, 505 - (count * 53.5), weapon["ammo"])
-        count += 1
-
-    # Skills Page
-    can.showPage()
-
-    skill_locations = {
-        "Acrobatics": 704,
-        "Appraise": 690,
-        "Bluff": 676,
-        "Climb": 662,
-        "Craft": 649,
-        "Diplomacy": 620,
-        "Disable Device": 607,
-        "Disguise": 593,
-        "Escape Artist": 579,
-        "Fly": 565,
-        "Handle Animal": 552,
-        "Heal": 538,
-        "Intimidate": 524,
-        "Knowledge (Arcana)": 510,
-        "Knowledge (Dungeoneering)": 496,
-        "Knowledge (Engineering)": 482,
-        "Knowledge (Geography)": 468,
-        "Knowledge (History)": 454,
-        "Knowledge (Local)": 441,
-        "Knowledge (Nature)": 427,
-        "Knowledge (Nobility)": 413,
-        "Knowledge (Planes)": 399,
-        "Knowledge (Religion)": 385,
-        "Linguistics": 372,
-        "Perception": 358,
-        "Perform": 344,
-        "Profession": 317,
-        "Ride": 289,
-        "Sense Motive": 275,
-        "Sleight of Hand": 262,
-        "Spellcraft": 248,
-        "Stealth": 234,
-        "Survival": 220,
-        "Swim": 206,
-        "Use Magic Device": 192,
-    }
+    claimed[stem] = label
+    return None
+
 
-    number_of_crafts = 0
-    number_of_performs = 0
-    number_of_professions = 0
-    skill_data = extract_skills(character)
-    for skill, data in skill_data.items():
-        can.setFont("Helvetica", 10)
-
-        y = 0
-        if skill.startswith("Craft") and data["total"] != "0":
-            y = skill_locations["Craft"]
-            can.setFont("Helvetica", 8)
-            can.drawString(85, y - (14 * number_of_crafts), extract_sub_skill(skill))
-            number_of_crafts += 1
-        elif skill.startswith("Perform") and data["total"] != "0":
-            y = skill_locations["Perform"]
-            can.setFont("Helvetica", 8)
-            can.drawString(95, y - (14 * number_of_performs), extract_sub_skill(skill))
-            number_of_performs += 1
-        elif skill.startswith("Profession") and data["total"] != "0":
-            y = skill_locations["Profession"]
-            can.setFont("Helvetica", 8)
-            can.drawString(
-                105, y - (14 * number_of_professions), extract_sub_skill(skill)
+# The folio rendered onto unless another template is given.
+FOLIO_TEMPLATE = "Player_Character_Folio.pdf"
+MANIFEST_NAME = "manifest.json"
+
+
+@dataclass(slots=True)
+class RenderResult:
+    filename: str
+    output_filename: str | None = None
+    elapsed: float = 0.0
+    error: str | None = None
+    skipped: bool = False
+    fingerprint: dict | None = None
+
+
+def load_manifest(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, MANIFEST_NAME)) as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return {}
+
+
+# What the manifest remembers of an output, so that a PDF that was replaced or
+# edited since it was rendered gets rendered again.
+def output_stat(output_filename):
+    stat = os.stat(output_filename)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def save_manifest(cache_dir, manifest):
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest_filename = os.path.join(cache_dir, MANIFEST_NAME)
+    with open(manifest_filename + ".tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    os.replace(manifest_filename + ".tmp", manifest_filename)
+
+
+# Exports every character in filenames. Given a cache_dir, files (but not
+# campaign records) are loaded through cached_character.
+def export_batch(
+    filenames, output_dir=".", format="json", campaign=False, cache_dir=None
+):
+    os.makedirs(output_dir, exist_ok=True)
+    load = load_character
+    if cache_dir is not None:
+        load = functools.partial(cached_character, cache_dir=cache_dir, format=format)
+    claimed = {}
+    start = time.perf_counter()
+    for label, character, error in iter_characters(filenames, campaign, load):
+        result = RenderResult(label, error=error or claim_output(claimed, label))
+        if result.error is None:
+            output_filename = os.path.join(
+                output_dir, output_stem(label) + EXPORT_FORMATS[format]
             )
-            number_of_professions += 1
-        elif skill in skill_locations:
-            y = skill_locations[skill]
-
-        if y > 0:
-            if data["class_skill"] == "1":
-                can.drawString(44, y, "x")
-            can.setFont("Helvetica", 10)
-            if data["ranks"] != "0":
-                can.drawString(162, y, data["ranks"])
-            if data["ability_mod"] != "0":
-                can.drawString(235, y, data["ability_mod"])
-            if data["misc_bonus"] != "0":
-                can.drawString(378, y, data["misc_bonus"])
-            if data["armorcheckmultiplier"] != "0":
-                can.drawString(412, y, "*")
-            if data["total"] != "0":
-                can.setFont("Helvetica-Bold", 12)
-                if len(data["total"]) == 1:
-                    can.drawString(457, y, data["total"])
-                elif data["total"][0] == "-":
-                    can.drawString(453, y, data["total"])
-                else:
-                    can.drawString(450, y, data["total"])
-
-    # Feats/Traits Page
-    can.showPage()
-    for i, feat in enumerate(extract_feats(character)):
-        can.setFont("Helvetica", 10)
-        can.drawString(40, 700 - (i * 14.5), feat["name"])
-        can.setFont("Helvetica", 8)
-        can.drawString(165, 700 - (i * 14.5), feat["description"])
-    for i, trait in enumerate(extract_traits(character)):
-        can.setFont("Helvetica", 10)
-        can.drawString(40, 225 - (i * 14.5), trait["name"])
-        can.setFont("Helvetica", 8)
-        can.drawString(165, 225 - (i * 14.5), trait["description"])
-
-    can.setFont("Helvetica", 10)
-    for i, langs in enumerate(partition(extract_languages(character), 8)):
-        can.drawString(40, 104 - (i * 14), ", ".join(langs))
-
-    # Spells Page
-    can.showPage()
-    line = 0
-    spell_data = extract_spells(character)
-    can.setFont("Helvetica", 8)
-    for level in range(0, 10):
-        for spell in spell_data[str(level)]:
-            can.setFont("Helvetica", 8)
-            y = 708 - (line * 15.1)
-            can.drawString(50, y, str(level))
-            can.drawString(80, y, spell["name"])
-            can.drawString(170, y, spell["school"])
-            can.drawString(235, y, summarize_save(spell, spell_data["dc"]))
-            can.drawString(
-                278, y, spell["sr"].split()[0].lower() if spell["sr"] else ""
+            try:
+                result.output_filename = write_export(
+                    character, output_filename, format
+                )
+            except Exception as e:
+                result.error = "{0}: {1}".format(type(e).__name__, e)
+        result.elapsed = time.perf_counter() - start
+        yield result
+        start = time.perf_counter()
+
+
+def print_diff(inputs, workers=None):
+    if len(inputs) != 2:
+        sys.stderr.write("--diff takes exactly two inputs\n")
+        return 2
+    old, new = inputs
+    if os.path.isdir(old) and os.path.isdir(new):
+        results = diff_rosters(old, new, workers)
+    else:
+        try:
+            changes = diff_files(old, new)
+        except Exception as e:
+            changes = "{0}: {1}".format(type(e).__name__, e)
+        results = [(old, new, changes)]
+    failures = 0
+    for old_filename, new_filename, changes in results:
+        if old_filename is None:
+            print("only in {0}: {1}".format(new, new_filename))
+        elif new_filename is None:
+            print("only in {0}: {1}".format(old, old_filename))
+        elif isinstance(changes, str):
+            failures += 1
+            sys.stderr.write("FAIL {0}: {1}\n".format(new_filename, changes))
+        elif changes:
+            print("--- {0}\n+++ {1}".format(old_filename, new_filename))
+            for change in changes:
+                print(change)
+    return 1 if failures else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Render Fantasy Grounds character exports onto the character folio."
+    )
+    parser.add_argument(
+        "inputs", nargs="+", help="character XML files, directories or glob patterns"
+    )
+    parser.add_argument(
+        "-o", "--output-dir", default=".", help="directory to write the PDFs to"
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=None,
+        help="number of worker processes (default: one per CPU)",
+    )
+    parser.add_argument(
+        "-t",
+        "--template",
+        default=FOLIO_TEMPLATE,
+        help="character folio PDF to draw onto (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--stamp",
+        action="store_true",
+        help="draw the template pages as shared form XObjects instead of merging"
+        " their content streams",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="write each page out as soon as it is merged instead of assembling"
+        " the whole document in memory first",
+    )
+    parser.add_argument(
+        "--dump",
+        choices=sorted(DUMP_FORMATS),
+        help="print the character data to stdout in this format instead of"
+        " rendering PDFs",
+    )
+    parser.add_argument(
+        "--sections",
+        help="comma separated sections to --dump (default: all of them: {0})".format(
+            ", ".join(DUMP_SECTIONS)
+        ),
+    )
+    parser.add_argument(
+        "--campaign",
+        action="store_true",
+        help="treat each input as a campaign db.xml and handle every character"
+        " in it, reading one character at a time",
+    )
+    parser.add_argument(
+        "--diff",
+        action="store_true",
+        help="report what changed between two inputs: two exports, or two"
+        " directories of exports matched up by file name",
+    )
+    parser.add_argument(
+        "--export",
+        choices=sorted(EXPORT_FORMATS),
+        help="write the extracted character data in this format instead of"
+        " rendering PDFs",
+    )
+    parser.add_argument(
+        "--combine",
+        metavar="PDF",
+        help="write every character into this single party folio, with a"
+        " bookmark per character",
+    )
+    parser.add_argument(
+        "--pipeline",
+        metavar="DEPTH",
+        type=int,
+        nargs="?",
+        const=4,
+        help="render in stages (read, parse, render, write) that run side by side,"
+        " with at most DEPTH characters queued between stages (default: 4), and"
+        " report how busy each stage was",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="keep a manifest here and skip characters whose data, template and"
+        " renderer are unchanged since the last run; with --export, keep the"
+        " extracted characters here so unchanged files are not parsed again",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="re-render everything even when the manifest says it is up to date",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="JSON",
+        default=os.environ.get(TRACE_VARIABLE),
+        help="time each extractor, page drawing, merge and write and save them as"
+        " Chrome trace events to this file, with a summary on stderr; renders run"
+        " in this process unless --pipeline is given (default: ${0})".format(
+            TRACE_VARIABLE
+        ),
+    )
+    args = parser.parse_args(argv)
+    if args.pipeline is not None and (args.campaign or args.combine or args.export):
+        parser.error("--pipeline only renders separate files")
+
+    if not args.trace:
+        return run(args)
+    trace = enable_tracing()
+    try:
+        return run(args)
+    finally:
+        trace.write(args.trace)
+        trace.report()
+
+
+def run(args):
+    if args.diff:
+        return print_diff(args.inputs, args.workers)
+
+    filenames = expand_inputs(args.inputs)
+    if args.dump:
+        sections = args.sections.split(",") if args.sections else None
+        if args.campaign:
+            sources = iter_characters(filenames, campaign=True)
+        else:
+            sources = ((filename, filename, None) for filename in filenames)
+        failures = 0
+        for label, source, error in sources:
+            if error is None:
+                try:
+                    dump(source, sys.stdout, args.dump, sections)
+                except Exception as e:
+                    error = "{0}: {1}".format(type(e).__name__, e)
+            if error is not None:
+                failures += 1
+                sys.stderr.write("FAIL {0}: {1}\n".format(label, error))
+        return 1 if failures else 0
+    manifest = load_manifest(args.cache_dir) if args.cache_dir else {}
+    rendered = skipped = failures = 0
+    start = time.perf_counter()
+    stages = None
+    if args.export:
+        results = export_batch(
+            filenames, args.output_dir, args.export, args.campaign, args.cache_dir
+        )
+    elif args.combine:
+        import folio
+
+        results = folio.to_party_pdf(
+            filenames,
+            args.combine,
+            args.template,
+            args.stamp,
+            args.stream,
+            args.campaign,
+        )
+    elif args.pipeline is not None:
+        import folio
+
+        results, stages = folio.render_pipeline(
+            filenames,
+            args.output_dir,
+            args.workers,
+            args.template,
+            args.stamp,
+            {} if args.force else manifest,
+            args.pipeline,
+        )
+    else:
+        import folio
+
+        results = folio.render_batch(
+            filenames,
+            args.output_dir,
+            # worker processes would keep their spans to themselves
+            0 if TRACE is not None else args.workers,
+            args.template,
+            args.stamp,
+            {} if args.force else manifest,
+            args.stream,
+            args.campaign,
+        )
+    for result in results:
+        if result.error:
+            failures += 1
+            print(
+                "FAIL {0} ({1:.2f}s): {2}".format(
+                    result.filename, result.elapsed, result.error
+                )
             )
-            can.drawString(300, y, process_equation(spell["range"], character_level))
-            duration = process_equation(spell["duration"], character_level)
-            can.setFont("Helvetica", 8 if duration[0] in "0123456789" else 6)
-            can.drawString(345, y, duration)
-            can.setFont("Helvetica", 6)
-            can.drawString(390, y, spell["summary"])
-            line += 1
-
-    # Inventory Page
-    can.showPage()
-
-    can.setFont("Helvetica", 8)
-    number_of_weapons = 0
-    number_of_armors = 0
-    number_of_goods = 0
-    number_of_magic = 0
-    number_of_rings = 0
-    number_of_wrists = 0
-    number_of_heads = 0
-    number_of_necks = 0
-    number_of_hands = 0
-    number_of_belts = 0
-    number_of_eyes = 0
-    number_of_headbands = 0
-    number_of_feet = 0
-    number_of_shoulders = 0
-    number_of_others = 0
-    for item in extract_inventory(character):
-        if item["type"] == "Goods and Services":
-            pass
-            # can.drawString(303, 200 - (number_of_goods * 15), item["name"])
-            # can.drawString(476, 196 - (number_of_goods * 15), item["cost"])
-            # can.drawString(520, 196 - (number_of_goods * 15), item["weight"])
-            # number_of_goods += 1
-        elif item["type"] == "Weapon":
-            can.drawString(40, 270 - (number_of_weapons * 15), item["name"])
-            can.drawString(212, 267 - (number_of_weapons * 15), item["cost"])
-            can.drawString(256, 267 - (number_of_weapons * 15), item["weight"])
-            number_of_weapons += 1
-        elif item["type"] == "Armor":
-            can.drawString(40, 151 - (number_of_armors * 15), item["name"])
-            can.drawString(212, 148 - (number_of_armors * 15), item["cost"])
-            can.drawString(256, 148 - (number_of_armors * 15), item["weight"])
-            number_of_armors += 1
-        elif (
-            item["type"] == "Wand"
-            or item["type"] == "Potion"
-            or item["type"] == "Scroll"
-        ):
-            can.drawString(303, 270 - (number_of_magic * 15), item["name"])
-            can.drawString(476, 267 - (number_of_magic * 15), item["cost"])
-            can.drawString(520, 267 - (number_of_magic * 15), item["weight"])
-            number_of_magic += 1
-        elif item["slot"]:
-            if item["slot"] == "ring":
-                can.drawString(435, 507 - (number_of_rings * 14), item["name"])
-                number_of_rings += 1
-            elif item["slot"] == "wrists":
-                can.drawString(40, 507 - (number_of_wrists * 14), item["name"])
-                number_of_wrists += 1
-            elif item["slot"] == "head":
-                can.drawString(40, 710 - (number_of_heads * 14), item["name"])
-                number_of_heads += 1
-            elif item["slot"] == "neck":
-                can.drawString(40, 643 - (number_of_necks * 14), item["name"])
-                number_of_necks += 1
-            elif item["slot"] == "hands":
-                can.drawString(40, 439 - (number_of_hands * 14), item["name"])
-                number_of_hands += 1
-            elif item["slot"] == "belt":
-                can.drawString(435, 371 - (number_of_belts * 14), item["name"])
-                number_of_belts += 1
-            elif item["slot"] == "eyes":
-                can.drawString(435, 643 - (number_of_eyes * 14), item["name"])
-                number_of_eyes += 1
-            elif item["slot"] == "headband":
-                can.drawString(435, 710 - (number_of_headbands * 14), item["name"])
-                number_of_headbands += 1
-            elif item["slot"] == "feet":
-                can.drawString(40, 371 - (number_of_feet * 14), item["name"])
-                number_of_feet += 1
-            elif item["slot"] == "shoulders":
-                can.drawString(435, 575 - (number_of_shoulders * 14), item["name"])
-                number_of_shoulders += 1
+            continue
+        if result.skipped:
+            skipped += 1
+            status = "skip"
         else:
-            can.drawString(303, 151 - (number_of_others * 15), item["name"])
-            if item["cost"]:
-                can.drawString(476, 148 - (number_of_others * 15), item["cost"])
-            if item["weight"]:
-                can.drawString(520, 148 - (number_of_others * 15), item["weight"])
-            number_of_others += 1
-
-    # Gear Page
-    can.showPage()
-    line = 0
-    can.setFont("Helvetica", 8)
-    for item in sorted(
-        sorted(extract_inventory(character), key=lambda i: i["name"]),
-        key=lambda i: i["type"],
-    ):
-        can.drawString(40, 714 - (line * 15.1), item["name"])
-        if item["cost"]:
-            can.drawString(212, 714 - (line * 15.1), item["cost"])
-        if item["weight"]:
-            can.drawString(256, 714 - (line * 15.1), item["weight"])
-        line += 1
-
-    encumbrance = extract_encumbrance(character)
-    can.drawString(40, 92, encumbrance["lightload"])
-    can.drawString(126, 92, encumbrance["mediumload"])
-    can.drawString(214, 92, encumbrance["heavyload"])
-    can.drawString(40, 73, encumbrance["liftoverhead"])
-    can.drawString(126, 73, encumbrance["liftoffground"])
-    can.drawString(214, 73, encumbrance["pushordrag"])
-
-    # # First background Page
-    # can.showPage()
-    # can.setFont("Helvetica", 8)
-
-    # can.drawString(60, 717, extract_age(character))
-    # can.drawString(157, 717, extract_height(character))
-    # can.drawString(247, 717, extract_weight(character))
-    # can.drawString(73, 700, extract_gender(character))
-
-    can.save()
-
-    # move to the beginning of the StringIO buffer
-    packet.seek(0)
-    new_pdf = PdfFileReader(packet)
-    # read your existing PDF
-    existing_pdf = PdfFileReader(open("Player_Character_Folio.pdf", "rb"))
-    output = PdfFileWriter()
-
-    character_page = existing_pdf.getPage(2)
-    character_page.mergePage(new_pdf.getPage(0))
-    output.addPage(character_page)
-
-    offense_page = existing_pdf.getPage(4)
-    offense_page.mergePage(new_pdf.getPage(1))
-    output.addPage(offense_page)
-
-    skill_page = existing_pdf.getPage(5)
-    skill_page.mergePage(new_pdf.getPage(2))
-    output.addPage(skill_page)
-
-    feat_page = existing_pdf.getPage(6)
-    feat_page.mergePage(new_pdf.getPage(3))
-    output.addPage(feat_page)
-
-    spell_page = existing_pdf.getPage(8)
-    spell_page.mergePage(new_pdf.getPage(4))
-    output.addPage(spell_page)
-
-    inventory_page = existing_pdf.getPage(9)
-    inventory_page.mergePage(new_pdf.getPage(5))
-    output.addPage(inventory_page)
-
-    gear_page = existing_pdf.getPage(10)
-    gear_page.mergePage(new_pdf.getPage(6))
-    output.addPage(gear_page)
-
-    # background1_page = existing_pdf.getPage(13)
-    # background1_page.mergePage(new_pdf.getPage(7))
-    # output.addPage(background1_page)
-
-    # finally, write "output" to a real file
-    outputStream = open("{0}.pdf".format(character_name), "wb")
-    output.write(outputStream)
-    outputStream.close()
-
-
-to_pdf("Simone_with_personal.xml")
+            rendered += 1
+            status = "ok  "
+        print(
+            "{0} {1} -> {2} ({3:.2f}s)".format(
+                status, result.filename, result.output_filename, result.elapsed
+            )
+        )
+        if result.fingerprint is not None:
+            manifest[os.path.abspath(result.filename)] = {
+                "fingerprint": result.fingerprint,
+                "output": result.output_filename,
+                "stat": output_stat(result.output_filename),
+            }
+    if args.cache_dir:
+        save_manifest(args.cache_dir, manifest)
+    print(
+        "{0} rendered, {1} unchanged, {2} failed in {3:.2f}s".format(
+            rendered, skipped, failures, time.perf_counter() - start
+        )
+    )
+    if args.cache_dir and args.export:
+        print(
+            "cache: {0} hits, {1} misses".format(
+                EXPORT_CACHE_STATS["hits"], EXPORT_CACHE_STATS["misses"]
+            )
+        )
+    elif args.cache_dir:
+        print("cache: {0} hits, {1} misses".format(skipped, rendered + failures))
+    if stages is not None:
+        folio.report_pipeline(stages, time.perf_counter() - start)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    # Run as the extract module that folio imports, rather than as a second
+    # copy of it under __main__.
+    import extract
+
+    sys.exit(extract.main())
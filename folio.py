@@ -0,0 +1,1367 @@
+from PyPDF2 import PdfFileWriter, PdfFileReader
+from PyPDF2.generic import (
+    ArrayObject,
+    DecodedStreamObject,
+    DictionaryObject,
+    IndirectObject,
+    NameObject,
+    NullObject,
+    NumberObject,
+    StreamObject,
+    createStringObject,
+)
+from reportlab.pdfgen import canvas
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.lib.pagesizes import letter
+import io
+import os
+import sys
+import math
+import json
+import time
+import hashlib
+import functools
+import asyncio
+import collections
+import concurrent.futures
+import dataclasses
+from dataclasses import dataclass
+import extract
+from extract import (
+    FOLIO_TEMPLATE,
+    RenderResult,
+    abs_value_of,
+    claim_output,
+    damage_sign_of,
+    iter_characters,
+    load_character,
+    output_stat,
+    output_stem,
+    process_equation,
+    summarize_save,
+)
+
+
+################################################################################
+# Folio template
+################################################################################
+
+# Folio pages the overlay pages are merged onto, in overlay page order.
+FOLIO_PAGES = [2, 4, 5, 6, 8, 9, 10]
+
+# Parsed templates by path, each alongside the mtime it was loaded at.
+TEMPLATE_CACHE = {}
+
+
+def copy_pdf_object(obj, pdf):
+    if isinstance(obj, IndirectObject):
+        return IndirectObject(obj.idnum, obj.generation, pdf)
+    if not isinstance(obj, (dict, list)):
+        return obj
+    copy = obj.__class__.__new__(obj.__class__)
+    for name, value in obj.__dict__.items():
+        if isinstance(value, IndirectObject):
+            value = copy_pdf_object(value, pdf)
+        elif isinstance(value, (PdfFileReader, TemplateCopy)):
+            value = pdf
+        copy.__dict__[name] = value
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            dict.__setitem__(copy, key, copy_pdf_object(value, pdf))
+    else:
+        list.extend(copy, [copy_pdf_object(value, pdf) for value in obj])
+    return copy
+
+
+def resolve_pdf_objects(obj, reader, seen):
+    if isinstance(obj, IndirectObject):
+        key = (obj.idnum, obj.generation)
+        if key not in seen:
+            seen.add(key)
+            resolve_pdf_objects(reader.getObject(obj), reader, seen)
+    elif isinstance(obj, dict):
+        for key, value in obj.items():
+            if key != "/Parent":
+                resolve_pdf_objects(value, reader, seen)
+    elif isinstance(obj, list):
+        for value in obj:
+            resolve_pdf_objects(value, reader, seen)
+
+
+def form_xobject(page, reader):
+    contents = page["/Contents"].getObject()
+    if isinstance(contents, ArrayObject):
+        form = DecodedStreamObject()
+        form.setData(b"\n".join(c.getObject().getData() for c in contents))
+    else:
+        # Keep the page's stream as it is stored, still compressed, so it is
+        # never decoded and re-encoded again.
+        form = copy_pdf_object(contents, reader)
+    form[NameObject("/Type")] = NameObject("/XObject")
+    form[NameObject("/Subtype")] = NameObject("/Form")
+    form[NameObject("/BBox")] = page["/MediaBox"]
+    form[NameObject("/Resources")] = page["/Resources"]
+    return form
+
+
+class FolioTemplate:
+    # The folio parsed once, with every object reachable from the pages we use
+    # resolved up front so later copies never go back to the file. Each of
+    # those pages is also wrapped as a form XObject (a "stamp") that stamped
+    # renders draw by reference instead of merging content streams.
+    def __init__(self, path):
+        with open(path, "rb") as template_file:
+            data = template_file.read()
+        self.path = path
+        self.digest = hashlib.sha256(data).hexdigest()
+        self.reader = PdfFileReader(io.BytesIO(data))
+        self.pages = {number: self.reader.getPage(number) for number in FOLIO_PAGES}
+        seen = set()
+        for page in self.pages.values():
+            resolve_pdf_objects(page, self.reader, seen)
+
+        # Stamps are numbered after the template's own objects so they can be
+        # looked up like any other indirect object.
+        self.stamps = {}
+        self.stamp_objects = {}
+        idnum = self.reader.trailer["/Size"]
+        for number, page in self.pages.items():
+            self.stamps[number] = idnum
+            self.stamp_objects[idnum] = form_xobject(page, self.reader)
+            idnum += 1
+
+    def copy(self):
+        return TemplateCopy(self)
+
+
+class TemplateCopy:
+    # A private view of a FolioTemplate for a single render. Objects are copied
+    # out of the shared template the first time they are looked up, so
+    # mergePage and PdfFileWriter can modify them freely.
+    def __init__(self, template):
+        self.template = template
+        self.objects = {}
+
+    def getObject(self, indirect_reference):
+        key = (indirect_reference.idnum, indirect_reference.generation)
+        if key not in self.objects:
+            if key[0] in self.template.stamp_objects:
+                original = self.template.stamp_objects[key[0]]
+            else:
+                reader = self.template.reader
+                original = reader.getObject(IndirectObject(key[0], key[1], reader))
+            self.objects[key] = copy_pdf_object(original, self)
+        return self.objects[key]
+
+    get_object = getObject
+
+    def getPage(self, number):
+        return copy_pdf_object(self.template.pages[number], self)
+
+    def stamp_page(self, number, overlay):
+        # Turns the overlay page into the output page: it draws the template
+        # page's stamp first and then its own content on top.
+        resources = overlay["/Resources"].getObject()
+        xobjects = resources.get("/XObject", DictionaryObject()).getObject()
+        xobjects[NameObject("/FolioPage")] = IndirectObject(
+            self.template.stamps[number], 0, self
+        )
+        resources[NameObject("/XObject")] = xobjects
+
+        draw_stamp = DecodedStreamObject()
+        draw_stamp.setData(b"q /FolioPage Do Q\n")
+        contents = ArrayObject([draw_stamp])
+        overlay_contents = overlay["/Contents"]
+        if isinstance(overlay_contents.getObject(), ArrayObject):
+            contents.extend(overlay_contents.getObject())
+        else:
+            contents.append(overlay_contents)
+        overlay[NameObject("/Contents")] = contents
+
+        template_page = self.template.pages[number]
+        for box in ("/MediaBox", "/CropBox", "/Rotate"):
+            if box in template_page:
+                overlay[NameObject(box)] = copy_pdf_object(template_page[box], self)
+        return overlay
+
+
+def detach_pdf_object(obj, pdf, memo):
+    # Replaces every reference into pdf that obj reaches with the object
+    # itself, so nothing is left pointing at pdf once it is discarded.
+    if isinstance(obj, IndirectObject):
+        if obj.pdf is not pdf:
+            return obj
+        key = (obj.idnum, obj.generation)
+        if key not in memo:
+            memo[key] = pdf.getObject(obj)
+            detach_pdf_object(memo[key], pdf, memo)
+        return memo[key]
+    if isinstance(obj, dict):
+        for key, value in list(obj.items()):
+            if key != "/Parent":
+                dict.__setitem__(obj, key, detach_pdf_object(value, pdf, memo))
+    elif isinstance(obj, list):
+        for i, value in enumerate(obj):
+            list.__setitem__(obj, i, detach_pdf_object(value, pdf, memo))
+    return obj
+
+
+def overlay_page(template, number, overlay, stamp=False):
+    if extract.TRACE is not None:
+        with extract.TRACE.span(
+            "{0} page {1}".format("stamp" if stamp else "merge", number), "merge"
+        ):
+            return merge_overlay(template, number, overlay, stamp)
+    return merge_overlay(template, number, overlay, stamp)
+
+
+def merge_overlay(template, number, overlay, stamp):
+    if stamp:
+        return template.stamp_page(number, overlay)
+    page = template.getPage(number)
+    page.mergePage(overlay)
+    return page
+
+
+def load_template(path=FOLIO_TEMPLATE):
+    mtime = os.stat(path).st_mtime_ns
+    cached = TEMPLATE_CACHE.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, FolioTemplate(path))
+        TEMPLATE_CACHE[path] = cached
+    return cached[1]
+
+
+# A stand-in for PdfFileWriter that writes each page, along with anything it
+# uses that has not been written yet, as soon as the page is added. Nothing
+# but the offsets of the objects written is kept, so memory use does not grow
+# with the number of pages. The page tree, outline and cross-reference table
+# are written by close(). The stream only needs a write method.
+class StreamingPdfWriter:
+    def __init__(self, stream):
+        self.stream = stream
+        self.position = 0
+        self.offsets = [None]
+        # (id of source pdf, idnum, generation) -> object number in the output
+        self.numbers = {}
+        self.sources = {}
+        self.pages = self.reserve()
+        self.page_numbers = []
+        self.bookmarks = []
+        self.write(b"%PDF-1.3\n%\xe2\xe3\xcf\xd3\n")
+
+    def write(self, data):
+        self.stream.write(data)
+        self.position += len(data)
+
+    def reserve(self):
+        self.offsets.append(None)
+        return len(self.offsets) - 1
+
+    def reference(self, obj, queue):
+        if obj.pdf is self:
+            return obj
+        key = (id(obj.pdf), obj.idnum, obj.generation)
+        number = self.numbers.get(key)
+        if number is None:
+            # keep the source alive so its id is not reused by another
+            self.sources[id(obj.pdf)] = obj.pdf
+            number = self.numbers[key] = self.reserve()
+            queue.append((number, obj.getObject()))
+        return IndirectObject(number, 0, self)
+
+    def translate(self, obj, queue):
+        # Renumbers the references obj holds in place, queueing the objects
+        # they point at. As when the template is copied, /Parent links are
+        # not followed.
+        if isinstance(obj, IndirectObject):
+            return self.reference(obj, queue)
+        if isinstance(obj, dict):
+            for key, value in list(obj.items()):
+                if key == "/Parent" and not (
+                    isinstance(value, IndirectObject) and value.pdf is self
+                ):
+                    dict.__delitem__(obj, key)
+                else:
+                    dict.__setitem__(obj, key, self.translate_value(value, queue))
+        elif isinstance(obj, list):
+            for i, value in enumerate(obj):
+                list.__setitem__(obj, i, self.translate_value(value, queue))
+        return obj
+
+    def translate_value(self, value, queue):
+        # Streams can only be written as objects of their own, so any held
+        # directly (as merged page contents are) get one.
+        if isinstance(value, StreamObject):
+            number = self.reserve()
+            queue.append((number, value))
+            return IndirectObject(number, 0, self)
+        return self.translate(value, queue)
+
+    def write_object(self, number, obj):
+        self.offsets[number] = self.position
+        self.write("{0} 0 obj\n".format(number).encode("ascii"))
+        (NullObject() if obj is None else obj).writeToStream(self, None)
+        self.write(b"\nendobj\n")
+
+    def flush(self, queue):
+        while queue:
+            number, obj = queue.pop()
+            self.write_object(number, self.translate(obj, queue))
+
+    def addPage(self, page):
+        number = self.reserve()
+        self.page_numbers.append(number)
+        queue = []
+        # anything on the page that points back at it gets this page
+        own = getattr(page, "indirectRef", None)
+        if own is not None and own.pdf is not None:
+            own_key = (id(own.pdf), own.idnum, own.generation)
+            self.numbers[own_key] = number
+        self.translate(page, queue)
+        page[NameObject("/Parent")] = IndirectObject(self.pages, 0, self)
+        self.write_object(number, page)
+        self.flush(queue)
+        if own is not None and own.pdf is not None:
+            del self.numbers[own_key]
+
+    def getNumPages(self):
+        return len(self.page_numbers)
+
+    def addBookmark(self, title, pagenum):
+        self.bookmarks.append((title, self.page_numbers[pagenum]))
+
+    def close(self):
+        kids = ArrayObject(
+            [IndirectObject(number, 0, self) for number in self.page_numbers]
+        )
+        pages = DictionaryObject()
+        pages[NameObject("/Type")] = NameObject("/Pages")
+        pages[NameObject("/Kids")] = kids
+        pages[NameObject("/Count")] = NumberObject(len(kids))
+        self.write_object(self.pages, pages)
+
+        catalog = DictionaryObject()
+        catalog[NameObject("/Type")] = NameObject("/Catalog")
+        catalog[NameObject("/Pages")] = IndirectObject(self.pages, 0, self)
+        if self.bookmarks:
+            catalog[NameObject("/Outlines")] = self.write_outline()
+        root = self.reserve()
+        self.write_object(root, catalog)
+
+        xref = self.position
+        self.write(
+            "xref\n0 {0}\n0000000000 65535 f \n".format(len(self.offsets)).encode(
+                "ascii"
+            )
+        )
+        for offset in self.offsets[1:]:
+            self.write("{0:010d} 00000 n \n".format(offset).encode("ascii"))
+        trailer = DictionaryObject()
+        trailer[NameObject("/Size")] = NumberObject(len(self.offsets))
+        trailer[NameObject("/Root")] = IndirectObject(root, 0, self)
+        self.write(b"trailer\n")
+        trailer.writeToStream(self, None)
+        self.write("\nstartxref\n{0}\n%%EOF\n".format(xref).encode("ascii"))
+
+    def write_outline(self):
+        outline = self.reserve()
+        items = [self.reserve() for _ in self.bookmarks]
+        for i, (title, page_number) in enumerate(self.bookmarks):
+            item = DictionaryObject()
+            item[NameObject("/Title")] = createStringObject(title)
+            item[NameObject("/Parent")] = IndirectObject(outline, 0, self)
+            item[NameObject("/Dest")] = ArrayObject(
+                [IndirectObject(page_number, 0, self), NameObject("/Fit")]
+            )
+            if i > 0:
+                item[NameObject("/Prev")] = IndirectObject(items[i - 1], 0, self)
+            if i < len(items) - 1:
+                item[NameObject("/Next")] = IndirectObject(items[i + 1], 0, self)
+            self.write_object(items[i], item)
+        outline_dict = DictionaryObject()
+        outline_dict[NameObject("/Type")] = NameObject("/Outlines")
+        outline_dict[NameObject("/First")] = IndirectObject(items[0], 0, self)
+        outline_dict[NameObject("/Last")] = IndirectObject(items[-1], 0, self)
+        outline_dict[NameObject("/Count")] = NumberObject(len(items))
+        self.write_object(outline, outline_dict)
+        return IndirectObject(outline, 0, self)
+
+
+def extract_sub_skill(skill):
+    op_index = skill.find("(")
+    cp_index = skill.find(")")
+    return skill[op_index + 1 : cp_index]
+
+
+def partition(l, n):
+    for i in range(0, len(l), n):
+        yield l[i : i + n]
+
+
+################################################################################
+# Sheet layout
+################################################################################
+
+# Where everything is drawn on the folio is read from a JSON layout and
+# compiled into draw ops once per layout file. A layout saved next to the
+# template as "<template>.layout.json" is used for that template, otherwise
+# the default one that ships with this script.
+FOLIO_LAYOUT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "folio_layout.json"
+)
+LAYOUT_CACHE = {}
+
+INVENTORY_SLOTS = [
+    "head",
+    "neck",
+    "wrists",
+    "hands",
+    "feet",
+    "headband",
+    "eyes",
+    "shoulders",
+    "ring",
+    "belt",
+]
+
+
+def inventory_tables(character):
+    tables = {name: [] for name in ["weapons", "armor", "magic", "other"]}
+    tables.update({slot: [] for slot in INVENTORY_SLOTS})
+    for item in character.inventory:
+        if item.type == "Goods and Services":
+            pass
+        elif item.type == "Weapon":
+            tables["weapons"].append(item)
+        elif item.type == "Armor":
+            tables["armor"].append(item)
+        elif item.type == "Wand" or item.type == "Potion" or item.type == "Scroll":
+            tables["magic"].append(item)
+        elif item.slot:
+            if item.slot in tables:
+                tables[item.slot].append(item)
+        else:
+            tables["other"].append(item)
+    return tables
+
+
+# Values a layout can refer to as though they were fields of the character.
+DERIVED_VALUES = {
+    "language_lines": lambda character: [
+        ", ".join(langs) for langs in partition(character.languages, 8)
+    ],
+    "spell_pages": lambda character: [
+        {
+            "caster": spell_class,
+            "rows": [
+                (level, spell, spell_class.dc)
+                for level in sorted(spell_class.spells)
+                for spell in spell_class.spells[level]
+            ],
+        }
+        for spell_class in character.spell_classes.values()
+    ],
+    "inventory_tables": inventory_tables,
+    "gear_rows": lambda character: sorted(
+        sorted(character.inventory, key=lambda i: i.name),
+        key=lambda i: i.type,
+    ),
+}
+
+# Named conversions a layout can apply to a value before it is drawn.
+TEXT_FORMATS = {
+    "damage": lambda weapon, character: "{0}{1}{2}".format(
+        weapon.damage_dice,
+        damage_sign_of(weapon.damage_bonus),
+        abs_value_of(weapon.damage_bonus),
+    ),
+    "save": lambda row, character: summarize_save(row[1], row[2]),
+    "caster": lambda caster, character: (
+        "{0} (DC {1})".format(caster.name, caster.dc) if caster else None
+    ),
+    "sr": lambda sr, character: sr.split()[0].lower() if sr else "",
+    "formula": lambda text, character: process_equation(text, character.level),
+}
+
+
+class SheetValues:
+    # The character as a layout sees it: its own fields plus DERIVED_VALUES,
+    # each worked out at most once per render.
+    def __init__(self, character):
+        self.character = character
+        self.derived = {}
+
+    def __getattr__(self, name):
+        if name not in DERIVED_VALUES:
+            return getattr(self.character, name)
+        if name not in self.derived:
+            self.derived[name] = DERIVED_VALUES[name](self.character)
+        return self.derived[name]
+
+
+# Turns a dotted path such as "ac.totals.general" or "1.name" into a function
+# that follows it through attributes, dictionary keys and list indexes. The
+# empty path stands for the value itself.
+def compile_path(path):
+    names = tuple(path.split(".")) if path else ()
+
+    def lookup(value):
+        for name in names:
+            if value is None:
+                return None
+            if isinstance(value, dict):
+                value = value.get(name)
+            elif isinstance(value, (list, tuple)):
+                value = value[int(name)]
+            else:
+                value = getattr(value, name)
+        return value
+
+    return lookup
+
+
+def rows_of(value):
+    if value is None:
+        return []
+    if isinstance(value, dict):
+        return list(value.values())
+    return list(value)
+
+
+# The same numbers and names are measured over and over in a batch.
+@functools.lru_cache(maxsize=65536)
+def string_width(text, font, size):
+    return stringWidth(text, font, size)
+
+
+# Returns text and the size to draw it at so that it is no wider than width:
+# the size shrinks as far as min_size, then the text is cut short.
+def fit_text(text, font, size, width, min_size):
+    full_width = string_width(text, font, size)
+    if width is None or full_width <= width:
+        return text, size
+    fitted = math.floor(size * width / full_width * 10) / 10
+    if fitted >= min_size:
+        return text, fitted
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if stringWidth(text[:middle].rstrip() + "...", font, min_size) <= width:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low].rstrip() + "...", min_size
+
+
+def set_font(can, font, size):
+    if can._fontname != font or can._fontsize != size:
+        can.setFont(font, size)
+
+
+@dataclass(slots=True, frozen=True)
+class DrawOp:
+    value: object
+    x: float
+    y: float
+    font: str
+    size: float
+    format: object = None
+    hide_zero: bool = False
+    mark: str | None = None
+    align: str = "left"
+    width: float | None = None
+    min_size: float | None = None
+    sub_size: float | None = None
+
+    def text(self, source, character):
+        value = self.value(source)
+        if self.format is not None:
+            value = self.format(value, character)
+        if value is None or (self.hide_zero and value == 0):
+            return None
+        return self.mark if self.mark is not None else str(value)
+
+    def draw(self, can, source, character, y, sub=False):
+        text = self.text(source, character)
+        if text is None:
+            return
+        size = self.sub_size if sub and self.sub_size is not None else self.size
+        text, size = fit_text(text, self.font, size, self.width, self.min_size or size)
+        x = self.x
+        if self.align == "right":
+            x -= string_width(text, self.font, size)
+        elif self.align == "center":
+            x -= string_width(text, self.font, size) / 2
+        set_font(can, self.font, size)
+        can.drawString(x, y, text)
+
+
+@dataclass(slots=True, frozen=True)
+class ListOp:
+    # Rows drawn a fixed step apart, on the first page of a section only.
+    rows: object
+    step: float
+    columns: list
+
+
+@dataclass(slots=True, frozen=True)
+class TableOp:
+    # Rows that continue on a copy of the page once capacity rows are drawn.
+    rows: object
+    row_height: float
+    capacity: int
+    columns: list
+
+
+@dataclass(slots=True, frozen=True)
+class SkillsOp:
+    # Skills sit on fixed rows, except that Craft, Perform and Profession
+    # skills with a total list their specialty on the rows below their own.
+    rows: dict
+    sub_skills: dict
+    sub_skill_step: float
+    sub_skill_size: float
+    font: str
+    columns: list
+
+
+@dataclass(slots=True, frozen=True)
+class Section:
+    # With repeat set, the section is drawn once for each of those values (at
+    # least once), and its fields, lists and tables look their values up in it.
+    # uses names the Character fields the section is drawn from, when known.
+    name: str
+    page: int
+    uses: tuple | None
+    repeat: object | None
+    fields: list
+    lists: list
+    tables: list
+    skills: SkillsOp | None
+
+
+@dataclass(slots=True, frozen=True)
+class Layout:
+    path: str
+    digest: str
+    sections: list
+
+
+def compile_op(spec, font, size, y=None):
+    return DrawOp(
+        value=compile_path(spec["text"]),
+        x=spec["x"],
+        y=spec.get("y", y),
+        font=spec.get("font", font),
+        size=spec.get("size", size),
+        format=TEXT_FORMATS[spec["format"]] if "format" in spec else None,
+        hide_zero=spec.get("hide") == "zero",
+        mark=spec.get("mark"),
+        align=spec.get("align", "left"),
+        width=spec.get("width"),
+        min_size=spec.get("min_size"),
+        sub_size=spec.get("sub_size"),
+    )
+
+
+def compile_section(spec):
+    font, size = spec["font"], spec["size"]
+    skills = None
+    if "skills" in spec:
+        skills_spec = spec["skills"]
+        skills = SkillsOp(
+            rows=skills_spec["rows"],
+            sub_skills=skills_spec["sub_skills"],
+            sub_skill_step=skills_spec["sub_skill_step"],
+            sub_skill_size=skills_spec["sub_skill_size"],
+            font=font,
+            columns=[
+                compile_op(column, font, size) for column in skills_spec["columns"]
+            ],
+        )
+    return Section(
+        name=spec["name"],
+        page=spec["page"],
+        uses=tuple(spec["uses"]) if "uses" in spec else None,
+        repeat=compile_path(spec["repeat"]) if "repeat" in spec else None,
+        fields=[compile_op(field, font, size) for field in spec.get("fields", [])],
+        lists=[
+            ListOp(
+                rows=compile_path(list_spec["rows"]),
+                step=list_spec["step"],
+                columns=[
+                    compile_op(column, font, size) for column in list_spec["columns"]
+                ],
+            )
+            for list_spec in spec.get("lists", [])
+        ],
+        tables=[
+            TableOp(
+                rows=compile_path(table["rows"]),
+                row_height=table["row_height"],
+                capacity=table["capacity"],
+                columns=[
+                    compile_op(column, font, size, table["top"] + column.get("dy", 0))
+                    for column in table["columns"]
+                ],
+            )
+            for table in spec.get("tables", [])
+        ],
+        skills=skills,
+    )
+
+
+def load_layout(path=FOLIO_LAYOUT):
+    mtime = os.stat(path).st_mtime_ns
+    cached = LAYOUT_CACHE.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, "rb") as layout_file:
+            data = layout_file.read()
+        layout = Layout(
+            path,
+            hashlib.sha256(data).hexdigest(),
+            [compile_section(section) for section in json.loads(data)["sections"]],
+        )
+        cached = (mtime, layout)
+        LAYOUT_CACHE[path] = cached
+    return cached[1]
+
+
+def layout_path(template=FOLIO_TEMPLATE):
+    path = os.path.splitext(template)[0] + ".layout.json"
+    return path if os.path.exists(path) else FOLIO_LAYOUT
+
+
+# Splits the rows of each table into page-sized runs in one pass. Returns the
+# (table, rows) runs for each page; there is always at least one page.
+def paginate(tables):
+    pages = [[]]
+    for table, rows in tables:
+        for start in range(0, len(rows), table.capacity):
+            index = start // table.capacity
+            if index == len(pages):
+                pages.append([])
+            pages[index].append((table, rows[start : start + table.capacity]))
+    return pages
+
+
+def draw_skills(can, skills, character):
+    counts = dict.fromkeys(skills.sub_skills, 0)
+    for skill, data in character.skills.items():
+        group = next((g for g in skills.sub_skills if skill.startswith(g)), None)
+        if group is not None and data.total != 0:
+            y = skills.rows[group] - (skills.sub_skill_step * counts[group])
+            set_font(can, skills.font, skills.sub_skill_size)
+            can.drawString(skills.sub_skills[group], y, extract_sub_skill(skill))
+            counts[group] += 1
+        elif skill in skills.rows:
+            group = None
+            y = skills.rows[skill]
+        else:
+            continue
+        for column in skills.columns:
+            column.draw(can, data, character, y, sub=group is not None)
+
+
+def draw_section(can, section, values, character, drawn):
+    if extract.TRACE is not None:
+        with extract.TRACE.span("draw " + section.name, "draw"):
+            return draw_section_pages(can, section, values, character, drawn)
+    return draw_section_pages(can, section, values, character, drawn)
+
+
+def draw_section_pages(can, section, values, character, drawn):
+    tables = [(table, rows_of(table.rows(values))) for table in section.tables]
+    for page_index, page in enumerate(paginate(tables)):
+        if drawn:
+            can.showPage()
+        drawn.append(section)
+        if page_index == 0:
+            for op in section.fields:
+                op.draw(can, values, character, op.y)
+            for list_op in section.lists:
+                for i, row in enumerate(rows_of(list_op.rows(values))):
+                    for op in list_op.columns:
+                        op.draw(can, row, character, op.y - (i * list_op.step))
+            if section.skills is not None:
+                draw_skills(can, section.skills, character)
+        for table, rows in page:
+            for i, row in enumerate(rows):
+                for op in table.columns:
+                    op.draw(can, row, character, op.y - (i * table.row_height))
+
+
+# Draws the given sections of the character onto the canvas one page at a
+# time, adding continuation pages where tables overflow, and returns the
+# section each canvas page belongs to.
+def draw_layout(can, sections, character):
+    values = SheetValues(character)
+    drawn = []
+    for section in sections:
+        scopes = [values]
+        if section.repeat is not None:
+            scopes = rows_of(section.repeat(values)) or [None]
+        for scope in scopes:
+            draw_section(can, section, scope, character, drawn)
+    return drawn
+
+
+# Merged pages of each section by section_key, least recently used first, so
+# a render only draws and merges the sections whose data changed since they
+# were last rendered. The cached pages are never handed out themselves, only
+# copies bound to the template copy of the render asking for them.
+PAGE_CACHE = collections.OrderedDict()
+PAGE_CACHE_SIZE = 256
+PAGE_CACHE_STATS = collections.Counter()
+
+
+def section_key(section, character, layout, template, stamp):
+    if section.uses is None:
+        uses = [field.name for field in dataclasses.fields(character)]
+    else:
+        uses = section.uses
+    data = {name: getattr(character, name) for name in uses}
+    digest = hashlib.sha256()
+    for part in (layout.digest, template.digest, RENDERER_VERSION, stamp, section.name):
+        digest.update("{0}\0".format(part).encode("utf-8"))
+    digest.update(json.dumps(data, sort_keys=True, default=repr).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def draw_pages(character, existing_pdf, sections, stamp):
+    packet = io.BytesIO()
+
+    # create a new PDF with Reportlab
+    can = canvas.Canvas(packet, pagesize=letter)
+    drawn = draw_layout(can, sections, character)
+    # save() drops a last page with nothing on it, which is all there is when
+    # the only section missing from the page cache draws nothing
+    can.showPage()
+    can.save()
+
+    # move to the beginning of the StringIO buffer
+    packet.seek(0)
+    new_pdf = PdfFileReader(packet)
+    output = [
+        overlay_page(existing_pdf, section.page, new_pdf.getPage(i), stamp)
+        for i, section in enumerate(drawn)
+    ]
+
+    # pull everything the pages need out of the overlay so its buffer can go
+    memo = {}
+    for page in output:
+        detach_pdf_object(page, new_pdf, memo)
+        if page.pdf is new_pdf:
+            page.pdf = None
+            page.indirectRef = None
+    return list(zip(drawn, output))
+
+
+def folio_pages(character, existing_pdf, stamp=False):
+    template = existing_pdf.template
+    layout = load_layout(layout_path(template.path))
+    keys = [
+        section_key(section, character, layout, template, stamp)
+        for section in layout.sections
+    ]
+    missing = [
+        section for section, key in zip(layout.sections, keys) if key not in PAGE_CACHE
+    ]
+    drawn = collections.defaultdict(list)
+    if missing:
+        for section, page in draw_pages(character, existing_pdf, missing, stamp):
+            drawn[id(section)].append(page)
+
+    pages = []
+    for section, key in zip(layout.sections, keys):
+        if id(section) in drawn:
+            PAGE_CACHE_STATS["misses"] += 1
+            if extract.TRACE is not None:
+                extract.TRACE.count("page cache misses")
+            pages.extend(drawn[id(section)])
+            PAGE_CACHE[key] = [
+                copy_pdf_object(page, None) for page in drawn[id(section)]
+            ]
+        else:
+            PAGE_CACHE_STATS["hits"] += 1
+            if extract.TRACE is not None:
+                extract.TRACE.count("page cache hits")
+            PAGE_CACHE.move_to_end(key)
+            pages.extend(
+                copy_pdf_object(page, existing_pdf) for page in PAGE_CACHE[key]
+            )
+    while len(PAGE_CACHE) > PAGE_CACHE_SIZE:
+        PAGE_CACHE.popitem(last=False)
+    return pages
+
+
+def to_pdf(
+    filename, output_dir=".", template=FOLIO_TEMPLATE, stamp=False, streaming=False
+):
+    output_filename = os.path.join(output_dir, output_stem(filename) + ".pdf")
+    character = load_character(filename)
+    return write_folio(character, output_filename, template, stamp, streaming)
+
+
+def write_folio(
+    character, output_filename, template=FOLIO_TEMPLATE, stamp=False, streaming=False
+):
+    # finally, write "output" to a real file: next to it first, and renamed
+    # over it once complete, so a render that fails leaves the last PDF alone
+    temporary_filename = "{0}.{1}.tmp".format(output_filename, os.getpid())
+    try:
+        with open(temporary_filename, "wb") as outputStream:
+            render_folio(character, outputStream, template, stamp, streaming)
+        os.replace(temporary_filename, output_filename)
+    except BaseException:
+        if os.path.exists(temporary_filename):
+            os.remove(temporary_filename)
+        raise
+    return output_filename
+
+
+def render_folio(
+    character, stream, template=FOLIO_TEMPLATE, stamp=False, streaming=False
+):
+    output = StreamingPdfWriter(stream) if streaming else PdfFileWriter()
+    for page in folio_pages(character, load_template(template).copy(), stamp):
+        output.addPage(page)
+    if extract.TRACE is not None:
+        with extract.TRACE.span("write", "write"):
+            finish_pdf(output, stream, streaming)
+    else:
+        finish_pdf(output, stream, streaming)
+
+
+def finish_pdf(output, stream, streaming):
+    if streaming:
+        output.close()
+    else:
+        output.write(stream)
+
+
+# Renders every character into a single party folio. All characters share
+# one copy of the template, so its fonts, images and (when stamping) page
+# stamps are written to the file once. Characters that fail to render are
+# left out and reported in the returned results. When streaming, each
+# character's pages are written out before the next character is read.
+def to_party_pdf(
+    filenames,
+    output_filename,
+    template=FOLIO_TEMPLATE,
+    stamp=False,
+    streaming=False,
+    campaign=False,
+):
+    existing_pdf = load_template(template).copy()
+    outputStream = open(output_filename, "wb")
+    output = StreamingPdfWriter(outputStream) if streaming else PdfFileWriter()
+    results = []
+    start = time.perf_counter()
+    for label, character, error in iter_characters(filenames, campaign):
+        result = RenderResult(label, error=error)
+        if error is None:
+            try:
+                pages = folio_pages(character, existing_pdf, stamp)
+                first_page = output.getNumPages()
+                for page in pages:
+                    output.addPage(page)
+                # characters without a name are bookmarked by where they came from
+                output.addBookmark(character.name or output_stem(label), first_page)
+            except Exception as e:
+                result.error = "{0}: {1}".format(type(e).__name__, e)
+            else:
+                result.output_filename = output_filename
+        result.elapsed = time.perf_counter() - start
+        results.append(result)
+        start = time.perf_counter()
+
+    if extract.TRACE is not None:
+        with extract.TRACE.span("write", "write"):
+            finish_pdf(output, outputStream, streaming)
+    else:
+        finish_pdf(output, outputStream, streaming)
+    outputStream.close()
+    return results
+
+
+################################################################################
+# Batch rendering
+################################################################################
+
+# Bump whenever a change to the drawing code alters the PDFs, so that
+# incremental runs re-render everything once.
+RENDERER_VERSION = 4
+
+
+def character_digest(character):
+    data = json.dumps(dataclasses.asdict(character), sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def render_fingerprint(character, template, stamp):
+    return {
+        "character": character_digest(character),
+        "template": load_template(template).digest,
+        "layout": load_layout(layout_path(template)).digest,
+        "renderer": RENDERER_VERSION,
+        "stamp": stamp,
+    }
+
+
+def up_to_date(previous, fingerprint, output_filename):
+    try:
+        return (
+            previous is not None
+            and previous["fingerprint"] == fingerprint
+            and previous["output"] == output_filename
+            and previous.get("stat") == output_stat(output_filename)
+        )
+    except FileNotFoundError:
+        return False
+
+
+# Renders one file, or the character already read from it when one is given.
+# When given its manifest entry from an earlier run, the render is skipped if
+# neither the character data, the template, nor the renderer changed and the
+# earlier PDF is still there as it was written.
+def render_one(
+    filename,
+    output_dir,
+    template,
+    stamp,
+    previous=None,
+    streaming=False,
+    character=None,
+):
+    result = RenderResult(filename)
+    start = time.perf_counter()
+    try:
+        if character is None:
+            character = load_character(filename)
+        result.fingerprint = render_fingerprint(character, template, stamp)
+        output_filename = os.path.join(output_dir, output_stem(filename) + ".pdf")
+        if up_to_date(previous, result.fingerprint, output_filename):
+            result.skipped = True
+            result.output_filename = output_filename
+        else:
+            result.output_filename = write_folio(
+                character, output_filename, template, stamp, streaming
+            )
+    except Exception as e:
+        result.error = "{0}: {1}".format(type(e).__name__, e)
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+def render_batch(
+    filenames,
+    output_dir=".",
+    workers=None,
+    template=FOLIO_TEMPLATE,
+    stamp=False,
+    manifest=None,
+    streaming=False,
+    campaign=False,
+):
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = manifest if manifest is not None else {}
+    if campaign:
+        yield from render_campaigns(
+            filenames, output_dir, workers, template, stamp, manifest, streaming
+        )
+        return
+    claimed = {}
+    if workers == 0:
+        for filename in filenames:
+            collision = claim_output(claimed, filename)
+            if collision is not None:
+                yield RenderResult(filename, error=collision)
+                continue
+            previous = manifest.get(os.path.abspath(filename))
+            yield render_one(filename, output_dir, template, stamp, previous, streaming)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for filename in filenames:
+            collision = claim_output(claimed, filename)
+            if collision is not None:
+                yield RenderResult(filename, error=collision)
+                continue
+            futures.append(
+                executor.submit(
+                    render_one,
+                    filename,
+                    output_dir,
+                    template,
+                    stamp,
+                    manifest.get(os.path.abspath(filename)),
+                    streaming,
+                )
+            )
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+
+# Reads the campaign databases in this process and hands each character to the
+# workers as it is read. Only a couple of characters per worker are read ahead,
+# so memory stays bounded however large the campaign is.
+def render_campaigns(
+    filenames, output_dir, workers, template, stamp, manifest, streaming
+):
+    claimed = {}
+    if workers == 0:
+        for label, character, error in iter_characters(filenames, campaign=True):
+            error = error or claim_output(claimed, label)
+            if error is not None:
+                yield RenderResult(label, error=error)
+                continue
+            previous = manifest.get(os.path.abspath(label))
+            yield render_one(
+                label, output_dir, template, stamp, previous, streaming, character
+            )
+        return
+    read_ahead = 2 * (workers or os.cpu_count() or 1)
+    pending = set()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for label, character, error in iter_characters(filenames, campaign=True):
+            error = error or claim_output(claimed, label)
+            if error is not None:
+                yield RenderResult(label, error=error)
+                continue
+            if len(pending) >= read_ahead:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    yield future.result()
+            pending.add(
+                executor.submit(
+                    render_one,
+                    label,
+                    output_dir,
+                    template,
+                    stamp,
+                    manifest.get(os.path.abspath(label)),
+                    streaming,
+                    character,
+                )
+            )
+        for future in concurrent.futures.as_completed(pending):
+            yield future.result()
+
+
+################################################################################
+# Pipelined rendering
+################################################################################
+
+
+@dataclass(slots=True)
+class StageStats:
+    name: str
+    workers: int
+    items: int = 0
+    busy: float = 0.0
+    max_queued: int = 0
+    queued: int = 0
+    samples: int = 0
+
+    def sample(self, queue):
+        depth = queue.qsize()
+        self.max_queued = max(self.max_queued, depth)
+        self.queued += depth
+        self.samples += 1
+
+
+def read_file(filename):
+    with open(filename, "rb") as input_file:
+        return input_file.read()
+
+
+def write_file(filename, data):
+    with open(filename, "wb") as output_file:
+        output_file.write(data)
+
+
+def parse_character(data):
+    return load_character(io.BytesIO(data))
+
+
+# The render stage: returns the character's fingerprint, the PDF to write it
+# to and the PDF itself, or None when the earlier PDF is still up to date.
+def render_character(character, output_filename, template, stamp, previous):
+    fingerprint = render_fingerprint(character, template, stamp)
+    if up_to_date(previous, fingerprint, output_filename):
+        return fingerprint, output_filename, None
+    pdf = io.BytesIO()
+    render_folio(character, pdf, template, stamp)
+    return fingerprint, output_filename, pdf.getvalue()
+
+
+# Runs one worker of a stage: takes (result, value) pairs from inbox, runs
+# them through step and passes what it returns on to outbox, until it takes
+# None. A pair whose step fails, or returns None, is finished there.
+async def pipeline_worker(stats, slot, inbox, outbox, step, finish):
+    while True:
+        item = await inbox.get()
+        if item is None:
+            return
+        stats.sample(inbox)
+        result, value = item
+        start = time.perf_counter()
+        try:
+            value = await step(result, value)
+        except Exception as e:
+            result.error = "{0}: {1}".format(type(e).__name__, e)
+            value = None
+        end = time.perf_counter()
+        stats.busy += end - start
+        if extract.TRACE is not None:
+            extract.TRACE.add(stats.name, "pipeline", start, end, slot)
+        stats.items += 1
+        if value is None:
+            finish(result)
+        else:
+            await outbox.put((result, value))
+
+
+async def run_pipeline(
+    filenames, output_dir, workers, template, stamp, manifest, depth
+):
+    loop = asyncio.get_running_loop()
+    workers = workers or os.cpu_count() or 1
+    parse_workers = max(1, workers // 4)
+    io_workers = 4
+    io_pool = concurrent.futures.ThreadPoolExecutor(io_workers)
+    parse_pool = concurrent.futures.ProcessPoolExecutor(parse_workers)
+    render_pool = concurrent.futures.ProcessPoolExecutor(
+        workers, initializer=load_template, initargs=(template,)
+    )
+    started = {}
+    results = []
+
+    def finish(result):
+        result.elapsed = time.perf_counter() - started.pop(id(result))
+        results.append(result)
+
+    async def read(result, filename):
+        started[id(result)] = time.perf_counter()
+        return await loop.run_in_executor(io_pool, read_file, filename)
+
+    async def parse(result, data):
+        return await loop.run_in_executor(parse_pool, parse_character, data)
+
+    async def render(result, character):
+        previous = manifest.get(os.path.abspath(result.filename))
+        result.fingerprint, result.output_filename, pdf = await loop.run_in_executor(
+            render_pool,
+            render_character,
+            character,
+            os.path.join(output_dir, output_stem(result.filename) + ".pdf"),
+            template,
+            stamp,
+            previous,
+        )
+        if pdf is None:
+            result.skipped = True
+            return None
+        return result.output_filename, pdf
+
+    async def write(result, output):
+        await loop.run_in_executor(io_pool, write_file, *output)
+
+    stages = [
+        (StageStats("read", io_workers), read),
+        (StageStats("parse", parse_workers), parse),
+        (StageStats("render", workers), render),
+        (StageStats("write", io_workers), write),
+    ]
+    # only the list of files is unbounded; every later stage waits once depth
+    # items are queued for the next one
+    inboxes = [asyncio.Queue()] + [asyncio.Queue(depth) for _ in stages[1:]]
+    claimed = {}
+    for filename in filenames:
+        collision = claim_output(claimed, filename)
+        if collision is not None:
+            results.append(RenderResult(filename, error=collision))
+        else:
+            inboxes[0].put_nowait((RenderResult(filename), filename))
+    for _ in range(stages[0][0].workers):
+        inboxes[0].put_nowait(None)
+
+    async def run_stage(index):
+        stats, step = stages[index]
+        outbox = inboxes[index + 1] if index + 1 < len(stages) else None
+        await asyncio.gather(
+            *(
+                pipeline_worker(
+                    stats,
+                    "{0} {1}".format(stats.name, slot + 1),
+                    inboxes[index],
+                    outbox,
+                    step,
+                    finish,
+                )
+                for slot in range(stats.workers)
+            )
+        )
+        if outbox is not None:
+            for _ in range(stages[index + 1][0].workers):
+                await outbox.put(None)
+
+    try:
+        await asyncio.gather(*(run_stage(index) for index in range(len(stages))))
+    finally:
+        io_pool.shutdown()
+        parse_pool.shutdown()
+        render_pool.shutdown()
+    return results, [stats for stats, step in stages]
+
+
+# Renders files through a pipeline of stages joined by queues of at most depth
+# items: files are read by a few I/O threads, parsed in one pool of processes,
+# drawn and merged in another and written back by the I/O threads, so reading
+# and writing overlap with rendering. Returns the results and each stage's
+# StageStats.
+def render_pipeline(
+    filenames,
+    output_dir=".",
+    workers=None,
+    template=FOLIO_TEMPLATE,
+    stamp=False,
+    manifest=None,
+    depth=4,
+):
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = manifest if manifest is not None else {}
+    return asyncio.run(
+        run_pipeline(filenames, output_dir, workers, template, stamp, manifest, depth)
+    )
+
+
+def report_pipeline(stages, elapsed, out=sys.stdout):
+    out.write(
+        "{0:<8}{1:>8}{2:>8}{3:>10}{4:>13}{5:>12}{6:>13}\n".format(
+            "stage",
+            "workers",
+            "items",
+            "busy s",
+            "utilization",
+            "max queued",
+            "mean queued",
+        )
+    )
+    for stats in stages:
+        utilization = stats.busy / (elapsed * stats.workers) if elapsed else 0.0
+        out.write(
+            "{0:<8}{1:>8}{2:>8}{3:>10.2f}{4:>12.0%}{5:>12}{6:>13.1f}\n".format(
+                stats.name,
+                stats.workers,
+                stats.items,
+                stats.busy,
+                utilization,
+                stats.max_queued,
+                stats.queued / stats.samples if stats.samples else 0.0,
+            )
+        )
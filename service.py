@@ -0,0 +1,303 @@
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import hashlib
+import collections
+import urllib.parse
+import concurrent.futures
+import extract
+import folio
+
+
+################################################################################
+# Workers
+################################################################################
+
+
+# Runs once in each worker process, so the imports and the template parse are
+# paid for when the service starts rather than on every request. With
+# FOLIO_TRACE set, each worker also traces its renders.
+def warm_worker(template):
+    if os.environ.get(extract.TRACE_VARIABLE):
+        extract.enable_tracing()
+    folio.load_template(template)
+
+
+# Workers never learn when the service stops, so each one rewrites a trace of
+# its own after every render: FOLIO_TRACE with the worker's pid added.
+def write_trace():
+    root, ext = os.path.splitext(os.environ[extract.TRACE_VARIABLE])
+    extract.TRACE.write("{0}.{1}{2}".format(root, os.getpid(), ext or ".json"))
+
+
+# Raised for uploads that cannot be read as a character, as opposed to renders
+# that fail on the service's side.
+class ExtractionError(Exception):
+    pass
+
+
+def render_upload(data, template, stamp):
+    try:
+        try:
+            character = extract.load_character(io.BytesIO(data))
+        except Exception as e:
+            raise ExtractionError("{0}: {1}".format(type(e).__name__, e))
+        pdf = io.BytesIO()
+        folio.render_folio(character, pdf, template, stamp)
+        return character.name, pdf.getvalue()
+    finally:
+        if extract.TRACE is not None:
+            write_trace()
+
+
+################################################################################
+# Render queue
+################################################################################
+
+
+class QueueFull(Exception):
+    pass
+
+
+class RenderQueue:
+    # Hands renders to a pool of warm worker processes. Identical uploads that
+    # arrive while one is already being rendered wait for that render instead
+    # of starting their own, and new uploads are turned away once more than
+    # max_queued renders are waiting for a worker.
+    def __init__(self, workers, max_queued, template, stamp):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.template = template
+        self.stamp = stamp
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=warm_worker, initargs=(template,)
+        )
+        self.in_flight = {}
+        self.running = 0
+        self.latencies = collections.deque(maxlen=1000)
+        self.counters = collections.Counter()
+
+    def warm(self):
+        # Starts every worker now instead of on the first requests.
+        futures = [self.pool.submit(time.sleep, 0) for _ in range(self.workers)]
+        concurrent.futures.wait(futures)
+
+    @property
+    def depth(self):
+        return max(0, self.running - self.workers)
+
+    async def render(self, data):
+        key = hashlib.sha256(data).hexdigest()
+        future = self.in_flight.get(key)
+        if future is not None:
+            self.counters["coalesced"] += 1
+            return await asyncio.shield(future)
+        if self.depth >= self.max_queued:
+            self.counters["rejected"] += 1
+            raise QueueFull()
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self.pool, render_upload, data, self.template, self.stamp
+        )
+        self.in_flight[key] = future
+        self.running += 1
+        start = time.perf_counter()
+        try:
+            result = await asyncio.shield(future)
+        except Exception:
+            self.counters["failed"] += 1
+            raise
+        else:
+            self.counters["rendered"] += 1
+            self.latencies.append(time.perf_counter() - start)
+            return result
+        finally:
+            self.running -= 1
+            del self.in_flight[key]
+
+    def metrics(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(fraction):
+            if not latencies:
+                return None
+            return latencies[round(fraction * (len(latencies) - 1))]
+
+        return {
+            "workers": self.workers,
+            "queue_depth": self.depth,
+            "queue_limit": self.max_queued,
+            "in_flight": len(self.in_flight),
+            "rendered": self.counters["rendered"],
+            "coalesced": self.counters["coalesced"],
+            "rejected": self.counters["rejected"],
+            "failed": self.counters["failed"],
+            "latency_p50": percentile(0.5),
+            "latency_p95": percentile(0.95),
+        }
+
+    def close(self):
+        self.pool.shutdown()
+
+
+################################################################################
+# HTTP
+################################################################################
+
+MAX_UPLOAD = 16 * 1024 * 1024
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    422: "Unprocessable Entity",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+async def send(writer, status, body, content_type="text/plain", headers=()):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    lines = [
+        "HTTP/1.1 {0} {1}".format(status, REASONS[status]),
+        "Content-Type: {0}".format(content_type),
+        "Content-Length: {0}".format(len(body)),
+        "Connection: close",
+    ]
+    lines.extend("{0}: {1}".format(name, value) for name, value in headers)
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+    await writer.drain()
+
+
+# Character names are free text, so the header carries an ASCII stand-in and
+# the real name percent-encoded as RFC 5987 describes; either way no quote or
+# line break from the name reaches the header. Exports without a name are
+# valid, and are sent as "character.pdf".
+def content_disposition(name):
+    filename = (name or "character") + ".pdf"
+    fallback = "".join(
+        c if " " <= c <= "~" and c not in '"\\' else "_" for c in filename
+    )
+    return "attachment; filename=\"{0}\"; filename*=UTF-8''{1}".format(
+        fallback, urllib.parse.quote(filename, safe="")
+    )
+
+
+async def read_request(reader):
+    request_line = await reader.readline()
+    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return method, path.split("?")[0], headers
+
+
+async def handle(queue, reader, writer):
+    try:
+        try:
+            method, path, headers = await read_request(reader)
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            await send(writer, 400, "malformed request\n")
+            return
+
+        if path == "/metrics":
+            await send(writer, 200, json.dumps(queue.metrics()), "application/json")
+        elif path == "/health":
+            await send(writer, 200, "ok\n")
+        elif path != "/render":
+            await send(writer, 404, "not found\n")
+        elif method != "POST":
+            await send(writer, 405, "POST a character XML export\n")
+        elif length > MAX_UPLOAD:
+            await send(
+                writer, 413, "uploads are limited to {0} bytes\n".format(MAX_UPLOAD)
+            )
+        else:
+            data = await reader.readexactly(length)
+            try:
+                name, pdf = await queue.render(data)
+                disposition = content_disposition(name)
+            except QueueFull:
+                await send(
+                    writer, 503, "render queue is full\n", headers=[("Retry-After", 1)]
+                )
+            except ExtractionError as e:
+                await send(writer, 422, "{0}\n".format(e))
+            except Exception as e:
+                sys.stderr.write(
+                    "render failed: {0}: {1}\n".format(type(e).__name__, e)
+                )
+                await send(writer, 500, "render failed\n")
+            else:
+                await send(
+                    writer,
+                    200,
+                    pdf,
+                    "application/pdf",
+                    [("Content-Disposition", disposition)],
+                )
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host, port, queue):
+    server = await asyncio.start_server(
+        lambda reader, writer: handle(queue, reader, writer), host, port
+    )
+    print("listening on http://{0}:{1}/render".format(host, port))
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve character folios over HTTP: POST an export to /render.",
+        epilog="Set {0}=FILE to have each render process save Chrome trace events"
+        " for its renders to FILE with its pid added.".format(extract.TRACE_VARIABLE),
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=8080)
+    parser.add_argument(
+        "-j", "--workers", type=int, default=2, help="number of render processes"
+    )
+    parser.add_argument(
+        "-q",
+        "--queue",
+        type=int,
+        default=32,
+        help="renders allowed to wait for a worker before uploads get a 503",
+    )
+    parser.add_argument("-t", "--template", default=extract.FOLIO_TEMPLATE)
+    parser.add_argument("--stamp", action="store_true")
+    args = parser.parse_args(argv)
+
+    queue = RenderQueue(args.workers, args.queue, args.template, args.stamp)
+    queue.warm()
+    try:
+        asyncio.run(serve(args.host, args.port, queue))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        queue.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
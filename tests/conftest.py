@@ -0,0 +1,48 @@
+import os
+import sys
+import pytest
+from xml.etree import ElementTree
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SAMPLES = [
+    os.path.join(ROOT, name)
+    for name in (
+        "Simone.xml",
+        "Simone_with_personal.xml",
+        "Simone_with_ring.xml",
+        "Simone_with_wand.xml",
+    )
+]
+
+
+def sample(name):
+    return os.path.join(ROOT, name)
+
+
+# A campaign database holding the characters of the given exports.
+def campaign_xml(filenames):
+    root = ElementTree.Element("root")
+    charsheet = ElementTree.SubElement(root, "charsheet")
+    for number, filename in enumerate(filenames):
+        character = ElementTree.parse(filename).getroot().find("character")
+        character.tag = "id-{0:05d}".format(number + 1)
+        charsheet.append(character)
+    return ElementTree.tostring(root)
+
+
+# The folio itself is not distributed with the code, so the PDF tests render
+# onto a blank stand-in with as many pages.
+@pytest.fixture(scope="session")
+def template(tmp_path_factory):
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
+    path = str(tmp_path_factory.mktemp("template") / "folio.pdf")
+    can = canvas.Canvas(path, pagesize=A4)
+    for number in range(14):
+        can.drawString(40, 40, "page {0}".format(number + 1))
+        can.showPage()
+    can.save()
+    return path
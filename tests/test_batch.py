@@ -0,0 +1,159 @@
+import os
+import pytest
+from PyPDF2 import PdfFileReader
+
+import extract
+import folio
+from conftest import SAMPLES, campaign_xml, sample
+
+
+def stem(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+@pytest.fixture
+def duplicate(tmp_path):
+    path = tmp_path / "copy" / "Simone.xml"
+    path.parent.mkdir()
+    path.write_bytes(open(sample("Simone.xml"), "rb").read())
+    return str(path)
+
+
+def test_render_batch_names_outputs_after_inputs(tmp_path, template):
+    output_dir = tmp_path / "out"
+    results = list(folio.render_batch(SAMPLES, str(output_dir), 0, template))
+    assert [result.error for result in results] == [None] * len(SAMPLES)
+    assert [result.output_filename for result in results] == [
+        os.path.join(output_dir, stem(filename) + ".pdf") for filename in SAMPLES
+    ]
+    assert len(os.listdir(output_dir)) == len(SAMPLES)
+
+
+@pytest.mark.parametrize("workers", [0, 1])
+def test_render_batch_reports_colliding_outputs(tmp_path, template, duplicate, workers):
+    filenames = [sample("Simone.xml"), duplicate]
+    results = {
+        result.filename: result
+        for result in folio.render_batch(filenames, str(tmp_path), workers, template)
+    }
+    assert results[sample("Simone.xml")].error is None
+    assert results[duplicate].error == (
+        "output Simone would overwrite the output of {0}".format(sample("Simone.xml"))
+    )
+
+
+def test_render_batch_numbers_campaign_records(tmp_path, template):
+    campaign = tmp_path / "db.xml"
+    campaign.write_bytes(campaign_xml(SAMPLES[:3]))
+    output_dir = tmp_path / "out"
+    results = list(
+        folio.render_batch([str(campaign)], str(output_dir), 0, template, campaign=True)
+    )
+    assert [result.error for result in results] == [None] * 3
+    assert sorted(os.listdir(output_dir)) == ["db-1.pdf", "db-2.pdf", "db-3.pdf"]
+
+
+def test_pipeline_names_outputs_after_inputs(tmp_path, template, duplicate):
+    output_dir = tmp_path / "out"
+    results, stages = folio.render_pipeline(
+        SAMPLES + [duplicate], str(output_dir), 1, template
+    )
+    errors = {result.filename: result.error for result in results}
+    assert [errors[filename] for filename in SAMPLES] == [None] * len(SAMPLES)
+    assert errors[duplicate].startswith("output Simone would overwrite")
+    assert sorted(os.listdir(output_dir)) == sorted(
+        stem(filename) + ".pdf" for filename in SAMPLES
+    )
+
+
+def run(tmp_path, template, *options):
+    return extract.main(
+        [sample("Simone.xml"), "-o", str(tmp_path / "out"), "-t", template]
+        + ["--cache-dir", str(tmp_path / "cache"), "-j", "1"]
+        + list(options)
+    )
+
+
+def statuses(capsys):
+    return [line.split()[0] for line in capsys.readouterr().out.splitlines()[:1]]
+
+
+def test_manifest_skips_unchanged_characters(tmp_path, template, capsys):
+    assert run(tmp_path, template) == 0
+    assert statuses(capsys) == ["ok"]
+    assert run(tmp_path, template) == 0
+    assert statuses(capsys) == ["skip"]
+    assert run(tmp_path, template, "--force") == 0
+    assert statuses(capsys) == ["ok"]
+
+
+def test_manifest_rerenders_a_replaced_output(tmp_path, template, capsys):
+    run(tmp_path, template)
+    output = tmp_path / "out" / "Simone.pdf"
+    output.write_bytes(b"not the folio")
+    capsys.readouterr()
+    run(tmp_path, template)
+    assert statuses(capsys) == ["ok"]
+    assert output.read_bytes().startswith(b"%PDF")
+
+
+def test_manifest_rerenders_a_missing_output(tmp_path, template, capsys):
+    run(tmp_path, template)
+    os.remove(tmp_path / "out" / "Simone.pdf")
+    capsys.readouterr()
+    run(tmp_path, template)
+    assert statuses(capsys) == ["ok"]
+
+
+def test_manifest_entries_are_kept_per_input(tmp_path, template, capsys):
+    run(tmp_path, template)
+    manifest = extract.load_manifest(str(tmp_path / "cache"))
+    (entry,) = manifest.values()
+    assert list(manifest) == [os.path.abspath(sample("Simone.xml"))]
+    assert entry["output"] == str(tmp_path / "out" / "Simone.pdf")
+    assert entry["stat"]["size"] == os.path.getsize(entry["output"])
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_party_folio_bookmarks_nameless_characters(tmp_path, template, streaming):
+    nameless = tmp_path / "nameless.xml"
+    with open(sample("Simone.xml"), encoding="utf-8") as sample_file:
+        data = sample_file.read().replace('<name type="string">Simone</name>', "")
+    nameless.write_text(data, encoding="utf-8")
+    output = tmp_path / "party.pdf"
+    results = folio.to_party_pdf(
+        [sample("Simone.xml"), str(nameless)], str(output), template, False, streaming
+    )
+    assert [result.error for result in results] == [None, None]
+    reader = PdfFileReader(str(output))
+    assert [bookmark.title for bookmark in reader.getOutlines()] == [
+        "Simone",
+        "nameless",
+    ]
+    assert reader.getNumPages() == 14
+
+
+def test_party_folio_skips_a_character_that_fails(tmp_path, template, monkeypatch):
+    real_folio_pages = folio.folio_pages
+
+    def folio_pages(character, existing_pdf, stamp=False):
+        if not character.inventory:
+            raise TypeError("cannot draw")
+        return real_folio_pages(character, existing_pdf, stamp)
+
+    monkeypatch.setattr(folio, "folio_pages", folio_pages)
+    broken = tmp_path / "broken.xml"
+    with open(sample("Simone.xml"), encoding="utf-8") as sample_file:
+        data = sample_file.read()
+    start, end = data.index("<inventorylist>"), data.index("</inventorylist>")
+    broken.write_text(
+        data[:start] + data[end + len("</inventorylist>") :], encoding="utf-8"
+    )
+    output = tmp_path / "party.pdf"
+    results = folio.to_party_pdf(
+        [str(broken), sample("Simone_with_ring.xml")], str(output), template
+    )
+    assert [result.error for result in results] == ["TypeError: cannot draw", None]
+    reader = PdfFileReader(str(output))
+    assert reader.getNumPages() == 7
+    assert [bookmark.title for bookmark in reader.getOutlines()] == ["Simone"]
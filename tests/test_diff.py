@@ -0,0 +1,102 @@
+import os
+
+import extract
+from conftest import sample
+
+
+def edited(tmp_path, name, old, new, count=1):
+    with open(sample("Simone.xml"), encoding="utf-8") as sample_file:
+        data = sample_file.read()
+    assert old in data
+    path = tmp_path / name
+    path.write_text(data.replace(old, new, count), encoding="utf-8")
+    return str(path)
+
+
+def diff_lines(old, new):
+    return [str(change) for change in extract.diff_files(old, new)]
+
+
+def test_identical_characters_have_no_changes():
+    assert diff_lines(sample("Simone.xml"), sample("Simone.xml")) == []
+
+
+def test_added_item():
+    lines = diff_lines(sample("Simone.xml"), sample("Simone_with_ring.xml"))
+    assert "+ inventory.Ring of Arcane Mastery" in lines
+    assert not any(line.startswith("- ") for line in lines)
+
+
+def test_removed_item_is_reported_the_other_way_round():
+    lines = diff_lines(sample("Simone_with_ring.xml"), sample("Simone.xml"))
+    assert "- inventory.Ring of Arcane Mastery" in lines
+
+
+def test_changed_value(tmp_path):
+    renamed = edited(
+        tmp_path,
+        "renamed.xml",
+        '<name type="string">Simone</name>',
+        '<name type="string">Simona</name>',
+    )
+    assert diff_lines(sample("Simone.xml"), renamed) == ["~ name: Simone -> Simona"]
+
+
+def test_prepared_spell(tmp_path):
+    prepared = edited(
+        tmp_path,
+        "prepared.xml",
+        '<prepared type="number">0</prepared>',
+        '<prepared type="number">2</prepared>',
+    )
+    assert diff_lines(sample("Simone.xml"), prepared) == [
+        "~ spells.id-00001/level 0/Detect Magic.prepared: 0 -> 2"
+    ]
+
+
+def test_reordered_entries_are_not_changes():
+    character = extract.load_character(sample("Simone.xml"))
+    reordered = extract.load_character(sample("Simone.xml"))
+    reordered.feats.reverse()
+    reordered.inventory.reverse()
+    assert extract.diff_characters(character, reordered) == []
+
+
+def test_print_diff(capsys):
+    status = extract.print_diff([sample("Simone.xml"), sample("Simone_with_ring.xml")])
+    out = capsys.readouterr().out.splitlines()
+    assert status == 0
+    assert out[:2] == [
+        "--- {0}".format(sample("Simone.xml")),
+        "+++ {0}".format(sample("Simone_with_ring.xml")),
+    ]
+    assert "+ inventory.Ring of Arcane Mastery" in out
+
+
+def test_print_diff_reports_unreadable_file(tmp_path, capsys):
+    broken = tmp_path / "broken.xml"
+    broken.write_text("<root><character>")
+    status = extract.print_diff([sample("Simone.xml"), str(broken)])
+    assert status == 1
+    assert capsys.readouterr().err.startswith("FAIL {0}: ParseError".format(broken))
+
+
+def test_diff_rosters(tmp_path):
+    old_dir, new_dir = tmp_path / "old", tmp_path / "new"
+    old_dir.mkdir()
+    new_dir.mkdir()
+    for name, old, new in [
+        ("simone.xml", "Simone.xml", "Simone_with_ring.xml"),
+        ("same.xml", "Simone.xml", "Simone.xml"),
+    ]:
+        (old_dir / name).write_bytes(open(sample(old), "rb").read())
+        (new_dir / name).write_bytes(open(sample(new), "rb").read())
+    (old_dir / "retired.xml").write_bytes(open(sample("Simone.xml"), "rb").read())
+    results = {
+        (old and os.path.basename(old), new and os.path.basename(new)): changes
+        for old, new, changes in extract.diff_rosters(str(old_dir), str(new_dir), 1)
+    }
+    assert results[("retired.xml", None)] is None
+    assert results[("same.xml", "same.xml")] == []
+    changes = results[("simone.xml", "simone.xml")]
+    assert "+ inventory.Ring of Arcane Mastery" in [str(change) for change in changes]
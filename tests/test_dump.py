@@ -0,0 +1,101 @@
+import io
+import csv
+import dataclasses
+import pytest
+
+import extract
+from conftest import sample
+
+
+def dumped(character_file, format, sections=None):
+    out = io.StringIO()
+    extract.dump(character_file, out, format, sections)
+    return out.getvalue()
+
+
+# The tables of a CSV dump, by title.
+def csv_tables(text):
+    tables = {}
+    for block in text.strip("\n").split("\n\n"):
+        rows = list(csv.reader(io.StringIO(block)))
+        tables[rows[0][0]] = rows[1:]
+    return tables
+
+
+def test_markdown():
+    assert dumped(sample("Simone.xml"), "markdown", ["name", "level", "feats"]) == (
+        "**Name:** Simone\n"
+        "\n"
+        "**Level:** 6\n"
+        "\n"
+        "## Feats\n"
+        "\n"
+        "- Alertness - +2 bonus on Perception and Sense Motive checks\n"
+        "- Combat Expertise - Trade attack bonus for AC bonus\n"
+        "- Extra Performance - Use bardic performance for 6 additional rounds per"
+        " day\n"
+        "- Improved Initiative - +4 bonus on initiative checks\n"
+        "- Dodge - +1 dodge bonus to AC\n"
+        "\n"
+    )
+
+
+def test_markdown_nests_spell_levels():
+    lines = dumped(sample("Simone.xml"), "markdown", ["spells"]).splitlines()
+    assert lines[:4] == ["## Spells", "", "- Level 0", "  - Detect Magic"]
+    assert "    - School: divination" in lines
+
+
+def test_csv():
+    tables = csv_tables(dumped(sample("Simone.xml"), "csv", ["name", "spells"]))
+    assert list(tables) == ["Name", "Spells"]
+    assert tables["Name"] == [["name", "value"], ["Name", "Simone"]]
+    header, *rows = tables["Spells"]
+    assert header == [
+        "group",
+        "name",
+        "School",
+        "Save",
+        "SR?",
+        "Range",
+        "Duration",
+        "Summary",
+    ]
+    heroism = next(row for row in rows if row[1] == "Heroism")
+    assert heroism[0] == "Level 2"
+    assert heroism[-1] == "Gives +2 on attack rolls, saves, skill checks."
+
+
+def test_csv_quotes_commas_and_quotes():
+    character = extract.load_character(sample("Simone.xml"))
+    feat = dataclasses.replace(character.feats[0], name='Dodge "Fast", Really')
+    character = dataclasses.replace(character, feats=[feat])
+    text = dumped(character, "csv", ["feats"])
+    assert '"Dodge ""Fast"", Really' in text
+    assert csv_tables(text)["Feats"][1][0].startswith('Dodge "Fast", Really - ')
+
+
+@pytest.mark.parametrize("format", sorted(extract.DUMP_FORMATS))
+def test_section_filter_matches_the_full_dump(format):
+    sections = ["name", "classes", "inventory", "spells"]
+    character = extract.load_character(sample("Simone_with_ring.xml"))
+    # a file name with sections goes through LazyCharacter
+    assert dumped(sample("Simone_with_ring.xml"), format, sections) == dumped(
+        character, format, sections
+    )
+    full = dumped(character, format)
+    for section in sections:
+        assert dumped(character, format, [section]) in full
+
+
+@pytest.mark.parametrize("format", sorted(extract.DUMP_FORMATS))
+def test_section_filter_leaves_other_sections_out(format):
+    text = dumped(sample("Simone.xml"), format, ["name"])
+    assert "Simone" in text
+    assert "Alertness" not in text
+    assert "Detect Magic" not in text
+
+
+def test_unknown_section():
+    with pytest.raises(ValueError, match="unknown dump sections: nope"):
+        dumped(sample("Simone.xml"), "text", ["name", "nope"])
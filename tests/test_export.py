@@ -0,0 +1,114 @@
+import os
+import copy
+import pytest
+from xml.etree import ElementTree
+
+import extract
+from conftest import SAMPLES, sample
+
+FORMATS = [
+    "json",
+    pytest.param(
+        "msgpack",
+        marks=pytest.mark.skipif(extract.msgpack is None, reason="needs msgpack"),
+    ),
+]
+
+
+@pytest.mark.parametrize("format", FORMATS)
+@pytest.mark.parametrize("filename", SAMPLES)
+def test_round_trip(filename, format):
+    character = extract.load_character(filename)
+    blob = extract.export_character(character, format)
+    assert extract.import_character(blob, format) == character
+
+
+@pytest.mark.parametrize("format", FORMATS)
+def test_round_trip_keeps_spell_classes_apart(tmp_path, format):
+    # two spell sets with the same label
+    tree = ElementTree.parse(sample("Simone.xml"))
+    spellset = tree.getroot().find("character/spellset")
+    second = copy.deepcopy(spellset.find("id-00001"))
+    second.tag = "id-00002"
+    spellset.append(second)
+    path = tmp_path / "two_bards.xml"
+    tree.write(path)
+
+    character = extract.load_character(str(path))
+    assert sorted(character.spell_classes) == ["id-00001", "id-00002"]
+    names = [spell_class.name for spell_class in character.spell_classes.values()]
+    assert names[0] == names[1]
+    blob = extract.export_character(character, format)
+    assert extract.import_character(blob, format) == character
+
+
+def test_cached_character_hits_and_misses(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    extract.EXPORT_CACHE_STATS.clear()
+    first = extract.cached_character(sample("Simone.xml"), cache_dir)
+    second = extract.cached_character(sample("Simone.xml"), cache_dir)
+    other = extract.cached_character(sample("Simone_with_ring.xml"), cache_dir)
+    assert first == second == extract.load_character(sample("Simone.xml"))
+    assert other == extract.load_character(sample("Simone_with_ring.xml"))
+    assert extract.EXPORT_CACHE_STATS == {"hits": 1, "misses": 2}
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def test_cached_character_rebuilds_truncated_entry(tmp_path):
+    cache_dir = tmp_path / "cache"
+    character = extract.cached_character(sample("Simone.xml"), str(cache_dir))
+    (entry,) = cache_dir.iterdir()
+    entry.write_bytes(entry.read_bytes()[:100])
+    extract.EXPORT_CACHE_STATS.clear()
+    assert extract.cached_character(sample("Simone.xml"), str(cache_dir)) == character
+    assert extract.EXPORT_CACHE_STATS == {"misses": 1}
+    assert extract.cached_character(sample("Simone.xml"), str(cache_dir)) == character
+    assert extract.EXPORT_CACHE_STATS == {"hits": 1, "misses": 1}
+
+
+def test_export_batch_names_outputs_after_inputs(tmp_path):
+    output_dir = tmp_path / "out"
+    results = list(extract.export_batch(SAMPLES, str(output_dir)))
+    assert [result.error for result in results] == [None] * len(SAMPLES)
+    assert sorted(os.listdir(output_dir)) == sorted(
+        os.path.splitext(os.path.basename(filename))[0] + ".json"
+        for filename in SAMPLES
+    )
+    for filename in SAMPLES:
+        name = os.path.splitext(os.path.basename(filename))[0] + ".json"
+        blob = (output_dir / name).read_bytes()
+        assert extract.import_character(blob) == extract.load_character(filename)
+
+
+def test_export_batch_reports_colliding_outputs(tmp_path):
+    duplicate = tmp_path / "copy" / "Simone.xml"
+    duplicate.parent.mkdir()
+    duplicate.write_bytes(open(sample("Simone.xml"), "rb").read())
+    results = list(
+        extract.export_batch(
+            [sample("Simone.xml"), str(duplicate)], str(tmp_path / "out")
+        )
+    )
+    assert results[0].error is None
+    assert results[1].error == "output Simone would overwrite the output of {0}".format(
+        sample("Simone.xml")
+    )
+
+
+def test_export_batch_through_the_cache(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    extract.EXPORT_CACHE_STATS.clear()
+    for output in ("first", "second"):
+        results = list(
+            extract.export_batch(
+                SAMPLES, str(tmp_path / output), "json", cache_dir=cache_dir
+            )
+        )
+        assert [result.error for result in results] == [None] * len(SAMPLES)
+    assert extract.EXPORT_CACHE_STATS == {
+        "hits": len(SAMPLES),
+        "misses": len(SAMPLES),
+    }
+    for name in os.listdir(tmp_path / "first"):
+        first = (tmp_path / "first" / name).read_bytes()
+        assert (tmp_path / "second" / name).read_bytes() == first
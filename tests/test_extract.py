@@ -0,0 +1,55 @@
+import io
+import pytest
+from xml.etree import ElementTree
+
+import extract
+from conftest import SAMPLES, campaign_xml, sample
+
+
+# What the extractors give when run on the whole parsed tree, as they were
+# before any streaming.
+def extract_from_tree(filename):
+    character = ElementTree.parse(filename).getroot().find("character")
+    sections = dict.fromkeys(extract.TEXT_SECTIONS)
+    for tag, (key, extractor) in extract.SECTION_EXTRACTORS.items():
+        if extract.find_first_child_named(character, tag) is not None:
+            sections[key] = extractor(character)
+    return sections
+
+
+@pytest.mark.parametrize("filename", SAMPLES)
+def test_read_character_matches_extractors(filename):
+    assert extract.read_character(filename) == extract_from_tree(filename)
+
+
+@pytest.mark.parametrize("filename", SAMPLES)
+def test_stream_characters_matches_extractors(filename):
+    streamed = list(extract.stream_characters(filename))
+    assert streamed == [extract_from_tree(filename)]
+
+
+def test_stream_characters_reads_every_campaign_record():
+    data = campaign_xml(SAMPLES)
+    streamed = list(extract.stream_characters(io.BytesIO(data)))
+    assert streamed == [extract_from_tree(filename) for filename in SAMPLES]
+
+
+def test_iter_characters_labels_campaign_records(tmp_path):
+    campaign = tmp_path / "db.xml"
+    campaign.write_bytes(campaign_xml(SAMPLES[:2]) + b"<broken")
+    results = list(extract.iter_characters([str(campaign)], campaign=True))
+    labels = [label for label, character, error in results]
+    assert labels == ["{0}#{1}".format(campaign, n) for n in (1, 2, 3)]
+    assert [character for label, character, error in results[:2]] == [
+        extract.load_character(filename) for filename in SAMPLES[:2]
+    ]
+    assert results[2][1] is None and results[2][2].startswith("ParseError")
+
+
+def test_load_character_matches_lazy_character():
+    filename = sample("Simone_with_personal.xml")
+    character = extract.load_character(filename)
+    lazy = extract.LazyCharacter(filename)
+    assert lazy.name == character.name
+    assert lazy.spell_classes == character.spell_classes
+    assert lazy.inventory == character.inventory
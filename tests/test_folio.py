@@ -0,0 +1,241 @@
+import io
+import os
+import dataclasses
+import types
+import pytest
+from PyPDF2 import PdfFileReader
+
+import extract
+import folio
+from conftest import sample
+
+# Pages of the folio's layout: character, offense, skills, feats, spells,
+# inventory and gear.
+SECTIONS = 7
+
+
+@pytest.fixture(autouse=True)
+def empty_page_cache():
+    folio.PAGE_CACHE.clear()
+    folio.PAGE_CACHE_STATS.clear()
+
+
+def table(capacity):
+    return types.SimpleNamespace(capacity=capacity)
+
+
+def simone():
+    return extract.load_character(sample("Simone.xml"))
+
+
+def page_count(character, template):
+    return len(folio.folio_pages(character, folio.load_template(template).copy()))
+
+
+def test_paginate_without_rows_gives_one_page():
+    assert folio.paginate([(table(10), [])]) == [[]]
+
+
+def test_paginate_splits_rows_by_capacity():
+    feats = table(10)
+    pages = folio.paginate([(feats, list(range(25)))])
+    assert [[len(rows) for _, rows in page] for page in pages] == [[10], [10], [5]]
+    assert [row for page in pages for _, rows in page for row in rows] == list(
+        range(25)
+    )
+
+
+def test_paginate_runs_tables_side_by_side():
+    feats, traits = table(32), table(8)
+    pages = folio.paginate([(feats, list(range(40))), (traits, list(range(20)))])
+    assert [[(t, len(rows)) for t, rows in page] for page in pages] == [
+        [(feats, 32), (traits, 8)],
+        [(feats, 8), (traits, 8)],
+        [(traits, 4)],
+    ]
+
+
+def test_folio_has_a_page_per_section(template):
+    assert page_count(simone(), template) == SECTIONS
+
+
+def test_long_feat_list_continues_on_extra_pages(template):
+    character = simone()
+    feats = [
+        dataclasses.replace(feat, name="{0} {1}".format(feat.name, copy))
+        for copy in range(14)
+        for feat in character.feats
+    ]
+    assert len(feats) == 70
+    character = dataclasses.replace(character, feats=feats)
+    # 32 feats a page
+    assert page_count(character, template) == SECTIONS + 2
+
+
+def test_long_spell_list_continues_on_extra_pages(template):
+    character = simone()
+    (spell_class,) = character.spell_classes.values()
+    spells = dict(spell_class.spells)
+    count = sum(len(level) for level in spells.values())
+    spells[1] = spells[1] + spells[1][:1] * (100 - count)
+    spell_class = dataclasses.replace(spell_class, spells=spells)
+    character = dataclasses.replace(character, spell_classes={"id-00001": spell_class})
+    # 42 spells a page
+    assert page_count(character, template) == SECTIONS + 2
+
+
+def test_each_spell_class_gets_its_own_pages(template):
+    character = simone()
+    (spell_class,) = character.spell_classes.values()
+    spell_classes = {
+        "id-00001": spell_class,
+        "id-00002": dataclasses.replace(spell_class, name="Wizard"),
+    }
+    character = dataclasses.replace(character, spell_classes=spell_classes)
+    assert page_count(character, template) == SECTIONS + 1
+
+
+def test_character_without_spells_keeps_the_spells_page(template):
+    character = dataclasses.replace(simone(), spell_classes={})
+    assert page_count(character, template) == SECTIONS
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_rendered_pdf_page_count(template, streaming):
+    character = simone()
+    character = dataclasses.replace(character, feats=character.feats * 14)
+    pdf = io.BytesIO()
+    folio.render_folio(character, pdf, template, streaming=streaming)
+    pdf.seek(0)
+    assert PdfFileReader(pdf).getNumPages() == SECTIONS + 2
+
+
+def page_texts(pdf):
+    pdf.seek(0)
+    reader = PdfFileReader(pdf)
+    return [reader.getPage(i).extractText() for i in range(reader.getNumPages())]
+
+
+def rendered_texts(character, template, stamp=False):
+    pdf = io.BytesIO()
+    folio.render_folio(character, pdf, template, stamp)
+    return page_texts(pdf)
+
+
+def test_page_cache_misses_then_hits(template):
+    character = simone()
+    drawn = rendered_texts(character, template)
+    assert folio.PAGE_CACHE_STATS == {"misses": SECTIONS}
+    assert rendered_texts(character, template) == drawn
+    assert folio.PAGE_CACHE_STATS == {"misses": SECTIONS, "hits": SECTIONS}
+
+
+def test_page_cache_redraws_only_changed_sections(template):
+    character = simone()
+    page_count(character, template)
+    folio.PAGE_CACHE_STATS.clear()
+    renamed = dataclasses.replace(character, name="Simona")
+    texts = rendered_texts(renamed, template)
+    # only the first page shows the name
+    assert folio.PAGE_CACHE_STATS == {"misses": 1, "hits": SECTIONS - 1}
+    assert "Simona" in texts[0]
+    assert not any("Simone" in text for text in texts)
+
+
+def test_page_cache_matches_a_fresh_render(template):
+    rendered_texts(simone(), template)
+    with_ring = extract.load_character(sample("Simone_with_ring.xml"))
+    cached = rendered_texts(with_ring, template)
+    assert folio.PAGE_CACHE_STATS["hits"] > 0
+    folio.PAGE_CACHE.clear()
+    assert rendered_texts(with_ring, template) == cached
+
+
+def test_page_cache_keeps_stamped_pages_apart(template):
+    character = simone()
+    page_count(character, template)
+    folio.folio_pages(character, folio.load_template(template).copy(), stamp=True)
+    assert folio.PAGE_CACHE_STATS == {"misses": 2 * SECTIONS}
+
+
+def test_page_cache_redraws_a_section_that_draws_nothing(template):
+    character = simone()
+    page_count(character, template)
+    folio.PAGE_CACHE_STATS.clear()
+    without_spells = dataclasses.replace(character, spell_classes={})
+    assert page_count(without_spells, template) == SECTIONS
+    assert folio.PAGE_CACHE_STATS == {"misses": 1, "hits": SECTIONS - 1}
+
+
+def test_page_cache_is_bounded(template, monkeypatch):
+    monkeypatch.setattr(folio, "PAGE_CACHE_SIZE", 3)
+    page_count(simone(), template)
+    assert len(folio.PAGE_CACHE) == 3
+
+
+def test_failed_render_keeps_the_last_pdf(tmp_path, template, monkeypatch):
+    output = tmp_path / "Simone.pdf"
+    folio.write_folio(simone(), str(output), template)
+    written = output.read_bytes()
+
+    def broken_render(character, stream, *args):
+        stream.write(b"%PDF-1.3\n")
+        raise TypeError("half way through")
+
+    monkeypatch.setattr(folio, "render_folio", broken_render)
+    with pytest.raises(TypeError):
+        folio.write_folio(simone(), str(output), template)
+    assert output.read_bytes() == written
+    assert os.listdir(tmp_path) == ["Simone.pdf"]
+
+
+FONT = "Helvetica"
+LONG_TEXT = "Ring of Arcane Mastery, Greater, of the Archmage"
+
+
+class RecordingCanvas:
+    def __init__(self):
+        self._fontname, self._fontsize = None, None
+        self.strings = []
+
+    def setFont(self, font, size):
+        self._fontname, self._fontsize = font, size
+
+    def drawString(self, x, y, text):
+        self.strings.append((x, y, text, self._fontsize))
+
+
+def test_fit_text_leaves_text_that_fits():
+    assert folio.fit_text("Simone", FONT, 10, 200, 6) == ("Simone", 10)
+    assert folio.fit_text(LONG_TEXT, FONT, 10, None, 6) == (LONG_TEXT, 10)
+
+
+def test_fit_text_shrinks_long_text():
+    width = folio.string_width(LONG_TEXT, FONT, 10) * 0.8
+    text, size = folio.fit_text(LONG_TEXT, FONT, 10, width, 6)
+    assert text == LONG_TEXT
+    assert 7.9 <= size < 8.1
+    assert folio.string_width(text, FONT, size) <= width
+
+
+def test_fit_text_cuts_text_that_cannot_shrink_enough():
+    text, size = folio.fit_text(LONG_TEXT, FONT, 10, 60, 6)
+    assert size == 6
+    assert text.endswith("...")
+    assert LONG_TEXT.startswith(text[:-3])
+    assert folio.string_width(text, FONT, size) <= 60
+    # one more character would not have fitted
+    longer = LONG_TEXT[: len(text) - 2].rstrip() + "..."
+    assert folio.string_width(longer, FONT, size) > 60
+
+
+@pytest.mark.parametrize("align, offset", [("left", 0), ("center", 0.5), ("right", 1)])
+def test_alignment_offsets_use_the_fitted_size(align, offset):
+    op = folio.DrawOp(
+        lambda source: source, 300, 700, FONT, 10, align=align, width=60, min_size=6
+    )
+    can = RecordingCanvas()
+    op.draw(can, LONG_TEXT, None, 700)
+    ((x, y, text, size),) = can.strings
+    assert size == 6
+    assert x == pytest.approx(300 - offset * folio.string_width(text, FONT, 6))
@@ -0,0 +1,96 @@
+import pytest
+
+import extract
+from conftest import SAMPLES
+
+# What the original, uncompiled process_equation gave for every range and
+# duration in the sample characters, at levels 1, 4, 9 and 20.
+EXPECTED = {
+    "1 day/level (D)": ["1 day", "4 days", "9 days", "20 days"],
+    "1 hour/level or until completed": ["1 hour", "4 hours", "9 hours", "20 hours"],
+    "1 min./level": ["1 min.", "4 mins.", "9 mins.", "20 mins."],
+    "1 min./level (D)": ["1 min.", "4 mins.", "9 mins.", "20 mins."],
+    "1 round/level": ["1 round", "4 rounds", "9 rounds", "20 rounds"],
+    "10 min./level": ["10 mins.", "40 mins.", "90 mins.", "200 mins."],
+    "10 min./level (D)": ["10 mins.", "40 mins.", "90 mins.", "200 mins."],
+    "2 hours/level": ["2 hours", "8 hours", "18 hours", "40 hours"],
+    "60 ft.": ["60 ft.", "60 ft.", "60 ft.", "60 ft."],
+    "Close (25 ft. + 5 ft./2 levels)": ["27.5 ft.", "35.0 ft.", "47.5 ft.", "75.0 ft."],
+    "Concentration, up to 1 min./level (D)": [
+        "1 min.",
+        "4 mins.",
+        "9 mins.",
+        "20 mins.",
+    ],
+    "Medium (100 ft. + 10 ft./level)": ["110 ft.", "140 ft.", "190 ft.", "300 ft."],
+    "concentration": ["concentration"] * 4,
+    "concentration, up to 1 min./level (D)": [
+        "1 min.",
+        "4 mins.",
+        "9 mins.",
+        "20 mins.",
+    ],
+    "instantaneous": ["instantaneous"] * 4,
+    "personal": ["personal"] * 4,
+    "touch": ["touch"] * 4,
+    "until landing or 1 round/level": ["1 round", "4 rounds", "9 rounds", "20 rounds"],
+}
+LEVELS = [1, 4, 9, 20]
+
+
+def sample_formulas():
+    formulas = set()
+    for filename in SAMPLES:
+        character = extract.load_character(filename)
+        for spell_class in character.spell_classes.values():
+            for spells in spell_class.spells.values():
+                for spell in spells:
+                    formulas.update((spell.range, spell.duration))
+    return formulas
+
+
+def test_expected_values_cover_the_samples():
+    assert sample_formulas() == set(EXPECTED)
+
+
+@pytest.mark.parametrize("formula", sorted(EXPECTED))
+def test_matches_the_original_evaluator(formula):
+    assert [extract.process_equation(formula, level) for level in LEVELS] == (
+        EXPECTED[formula]
+    )
+
+
+def test_level_may_be_given_as_text():
+    assert extract.process_equation("1 round/level", "3") == "3 rounds"
+
+
+def test_compiled_formulas_are_reused():
+    extract.compile_formula.cache_clear()
+    first = extract.compile_formula("1 min./level")
+    assert extract.compile_formula("1 min./level") is first
+    info = extract.compile_formula.cache_info()
+    assert (info.hits, info.misses) == (1, 1)
+    assert info.maxsize == extract.FORMULA_CACHE_SIZE
+
+
+def test_cache_is_bounded():
+    extract.compile_formula.cache_clear()
+    for number in range(extract.FORMULA_CACHE_SIZE + 10):
+        extract.compile_formula("{0} ft.".format(number))
+    assert extract.compile_formula.cache_info().currsize == extract.FORMULA_CACHE_SIZE
+
+
+# The original evaluator raised on these; they are shown as written instead.
+@pytest.mark.parametrize("formula", ["see text", "1d4 rounds", "1 round/three levels"])
+def test_unknown_tokens_fall_back_to_the_text(formula):
+    extract.UNPARSED_FORMULAS.clear()
+    assert not extract.compile_formula(formula).parsed
+    assert extract.process_equation(formula, 3) == formula
+    assert extract.process_equation(formula, 7) == formula
+    assert extract.UNPARSED_FORMULAS == {formula: 2}
+
+
+def test_plain_text_is_lowercased():
+    formula = extract.compile_formula("Permanent")
+    assert not formula.parsed
+    assert formula.evaluate(5) == "permanent"
@@ -0,0 +1,110 @@
+import asyncio
+import pytest
+
+import service
+from conftest import sample
+
+
+class FakeQueue:
+    def __init__(self, error=None, name='Simoné "x"\r\nX-Evil: 1'):
+        self.error = error
+        self.name = name
+
+    async def render(self, data):
+        if self.error is not None:
+            raise self.error
+        return self.name, b"%PDF"
+
+    def metrics(self):
+        return {}
+
+
+def request(queue, data):
+    async def exchange():
+        server = await asyncio.start_server(
+            lambda reader, writer: service.handle(queue, reader, writer),
+            "127.0.0.1",
+            0,
+        )
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(data)
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return response
+
+    head, _, body = asyncio.run(exchange()).partition(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    headers = dict(line.split(": ", 1) for line in lines[1:])
+    return int(lines[0].split()[1]), headers, body
+
+
+def upload(length, body=b""):
+    head = "POST /render HTTP/1.1\r\nContent-Length: {0}\r\n\r\n".format(length)
+    return head.encode("latin-1") + body
+
+
+def test_content_disposition_is_ascii_with_the_name_percent_encoded():
+    value = service.content_disposition('Simoné "x"\r\nX-Evil: 1')
+    assert value == (
+        'attachment; filename="Simon_ _x___X-Evil: 1.pdf"; '
+        "filename*=UTF-8''Simon%C3%A9%20%22x%22%0D%0AX-Evil%3A%201.pdf"
+    )
+    value.encode("ascii")
+
+
+def test_rendered_folio():
+    status, headers, body = request(FakeQueue(), upload(3, b"xml"))
+    assert status == 200
+    assert body == b"%PDF"
+    assert "X-Evil" not in headers
+    assert headers["Content-Disposition"].startswith('attachment; filename="Simon_')
+
+
+@pytest.mark.parametrize("length", ["-5", "x"])
+def test_bad_content_length(length):
+    assert request(FakeQueue(), upload(length))[0] == 400
+
+
+def test_unreadable_upload():
+    error = service.ExtractionError("ParseError: no element found")
+    status, headers, body = request(FakeQueue(error), upload(3, b"xml"))
+    assert status == 422
+    assert body == b"ParseError: no element found\n"
+
+
+def test_server_failure(capsys):
+    error = RuntimeError("the pool broke")
+    status, headers, body = request(FakeQueue(error), upload(3, b"xml"))
+    assert status == 500
+    assert "the pool broke" in capsys.readouterr().err
+
+
+def test_render_upload_wraps_extraction_errors(template):
+    with pytest.raises(service.ExtractionError, match="ParseError"):
+        service.render_upload(b"<root><character>", template, False)
+
+
+def test_content_disposition_without_a_name():
+    assert service.content_disposition(None) == (
+        "attachment; filename=\"character.pdf\"; filename*=UTF-8''character.pdf"
+    )
+
+
+def test_rendered_folio_without_a_name():
+    status, headers, body = request(FakeQueue(name=None), upload(3, b"xml"))
+    assert status == 200
+    assert headers["Content-Disposition"].startswith(
+        'attachment; filename="character.pdf"'
+    )
+
+
+def test_nameless_upload_is_rendered(template):
+    with open(sample("Simone.xml"), encoding="utf-8") as sample_file:
+        data = sample_file.read().replace('<name type="string">Simone</name>', "")
+    name, pdf = service.render_upload(data.encode("utf-8"), template, False)
+    assert name is None
+    assert pdf.startswith(b"%PDF")
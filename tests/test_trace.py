@@ -0,0 +1,52 @@
+import os
+import collections
+import json
+import pytest
+
+import extract
+import folio
+import service
+from conftest import sample
+
+
+@pytest.fixture
+def trace(monkeypatch):
+    monkeypatch.setattr(extract, "TRACE", None)
+    return extract.enable_tracing()
+
+
+def span_names(trace):
+    return {event["name"] for event in trace.events}
+
+
+def test_load_character_spans(trace):
+    extract.load_character(sample("Simone.xml"))
+    assert {"load_character", "extract_feats", "extract_spells"} <= span_names(trace)
+    assert trace.counters["characters"] == 1
+
+
+def test_lazy_character_spans_only_the_sections_read(trace):
+    character = extract.LazyCharacter(sample("Simone.xml"))
+    character.feats
+    assert span_names(trace) == {"extract_feats"}
+
+
+def test_service_workers_trace_from_the_environment(tmp_path, template, monkeypatch):
+    monkeypatch.setattr(extract, "TRACE", None)
+    monkeypatch.setenv(extract.TRACE_VARIABLE, str(tmp_path / "service.json"))
+    # a cached page is copied rather than drawn
+    monkeypatch.setattr(folio, "PAGE_CACHE", collections.OrderedDict())
+    service.warm_worker(template)
+    with open(sample("Simone.xml"), "rb") as sample_file:
+        service.render_upload(sample_file.read(), template, False)
+    filename = tmp_path / "service.{0}.json".format(os.getpid())
+    events = json.loads(filename.read_text())["traceEvents"]
+    names = {event["name"] for event in events}
+    assert {"load_character", "draw feats", "write"} <= names
+
+
+def test_tracing_is_off_without_the_variable(template, monkeypatch):
+    monkeypatch.setattr(extract, "TRACE", None)
+    monkeypatch.delenv(extract.TRACE_VARIABLE, raising=False)
+    service.warm_worker(template)
+    assert extract.TRACE is None